@@ -9,7 +9,7 @@
 """Create a python click context and inject it to the global flask commands."""
 
 import click
-from bdc_catalog.models import Application, CompositeFunction, db
+from bdc_catalog.models import Application, CompositeFunction, GridRefSys, db
 from flask.cli import FlaskGroup, with_appcontext
 
 from . import create_app
@@ -62,6 +62,23 @@ def load_data():
     db.session.commit()
 
 
+@cli.command('create-grid-geom-wgs84')
+@with_appcontext
+def create_grid_geom_wgs84():
+    """Add the precomputed EPSG:4326 geometry column to the existing grids."""
+    from .utils.processing import create_geom_wgs84_column
+
+    with db.session.begin_nested():
+        for grs in GridRefSys.query().all():
+            if not create_geom_wgs84_column(grs.geom_table):
+                click.secho(f'Grid {grs.name} skipped, PostgreSQL 12+ is required.', fg='yellow')
+                continue
+
+            click.secho(f'Grid {grs.name} updated.', fg='green')
+
+    db.session.commit()
+
+
 def main(as_module=False):
     """Load cube-builder as package in python module."""
     import sys
@@ -11,6 +11,11 @@
 
 SRID_BDC_GRID = 100001
 
+# Stored column with the grid tile geometry reprojected to EPSG:4326
+GEOM_WGS84_COLUMN = 'geom_4326'
+# Generated columns are supported from PostgreSQL 12 (server_version_num)
+GEOM_WGS84_MIN_SERVER_VERSION = 120000
+
 APPLICATION_ID = 1
 
 CLEAR_OBSERVATION_NAME = 'CLEAROB'
@@ -148,6 +153,31 @@ REVISIT_BY_SATELLITE = {
     'SENTINEL-2': 5
 }
 
+# Size (in pixels) of the square blocks used to warp and merge scenes
+MERGE_BLOCK_SIZE = 2048
+
+# Number of scenes downloaded and warped concurrently by a merge
+MERGE_MAX_WORKERS = 4
+
+# Number of warped blocks each scene of a merge reads ahead of the compositing. A merge holds at most
+# MERGE_MAX_WORKERS * (MERGE_BUFFERED_BLOCKS + 1) blocks of MERGE_BLOCK_SIZE² pixels (~100 MB in int16)
+MERGE_BUFFERED_BLOCKS = 2
+
+# Number of scenes read concurrently by a blend
+BLEND_MAX_WORKERS = 8
+
+# Number of lines grouped in each window when reading a striped (non tiled) raster
+READ_BLOCK_LINES = 512
+
+# Number of band assets of an item described (HEAD, checksum and raster metadata) concurrently by a publish
+PUBLISH_ASSET_MAX_WORKERS = 8
+
+# Number of quicklooks generated ahead of the item being registered by a publish
+QUICKLOOK_PREFETCH = 2
+
+# Decimation factor used to read an existing merged quality band to compute its statistics
+QA_STATISTICS_DECIMATION = 4
+
 COG_MIME_TYPE = 'image/tiff; application=geotiff; profile=cloud-optimized'
 
 PNG_MIME_TYPE = 'image/png'
@@ -36,7 +36,8 @@ from .maestro import (blend, harmonization, merge_warped, orchestrate,
                       solo)
 from .services import CubeServices
 from .utils.image import validate_merges
-from .utils.processing import (format_version, get_cube_parts, get_date,
+from .utils.processing import (create_geom_wgs84_column, format_version,
+                               get_cube_parts, get_date, get_geom_wgs84,
                                get_or_create_model)
 from .utils.serializer import DecimalEncoder, Serializer
 from .utils.timeline import Timeline
@@ -47,6 +48,8 @@ class CubeController:
 
     def __init__(self, bucket=None):
         self.score = {}
+        # Merge rasters kept alive between invocations of a warm worker
+        self.scratch_buffers = {}
 
         self.services = CubeServices(bucket)
 
@@ -582,8 +585,9 @@ class CubeController:
         bands_ids_list = {}
         quality_nodata = 0
         nodata = 0
+        indexes_names = {i['common_name'].upper() for i in indexes}
         for band in bands:
-            if band.name.upper() not in [i['common_name'].upper() for i in indexes]:
+            if band.name.upper() not in indexes_names:
                 bands_list.append(band.name)
                 bands_ids_list[band.id] = band.name
                 if band.name == quality_band:
@@ -600,11 +604,8 @@ class CubeController:
         bands_ql = Quicklook.query().filter(
             Quicklook.collection_id == cube_infos_irregular.id
         ).first()
-        bands_ql_list = [
-            list(filter(lambda b: b.id == bands_ql.red, bands))[0].name, 
-            list(filter(lambda b: b.id == bands_ql.green, bands))[0].name, 
-            list(filter(lambda b: b.id == bands_ql.blue, bands))[0].name
-        ]
+        band_names = {b.id: b.name for b in bands}
+        bands_ql_list = [band_names[bands_ql.red], band_names[bands_ql.green], band_names[bands_ql.blue]]
 
         # items => { 'tile_id': bbox, xmin, ..., periods: {'start_end': collection, ... } }
         # orchestrate
@@ -745,6 +746,8 @@ class CubeController:
             grs.description = description
             db.session.add(grs)
 
+            create_geom_wgs84_column(grs.geom_table)
+
             [db.session.add(Tile(**tile, grs=grs)) for tile in tiles]
         db.session.commit()        
 
@@ -770,7 +773,7 @@ class CubeController:
         geom_table = schema.geom_table
         tiles = db.session.query(
             geom_table.c.tile,
-            func.ST_AsGeoJSON(func.ST_Transform(geom_table.c.geom, 4326), 6, 3).cast(sqlalchemy.JSON).label('geom_wgs84')
+            func.ST_AsGeoJSON(get_geom_wgs84(geom_table), 6, 3).cast(sqlalchemy.JSON).label('geom_wgs84')
         ).all()
 
         dump_grs = Serializer.serialize(schema)
@@ -810,11 +813,9 @@ class CubeController:
 
         dump_cube = Serializer.serialize(cube)
         dump_cube['bands'] = [Serializer.serialize(b) for b in cube.bands]
-        dump_cube['quicklook'] = [
-            list(filter(lambda b: b.id == cube.quicklook[0].red, cube.bands))[0].name,
-            list(filter(lambda b: b.id == cube.quicklook[0].green, cube.bands))[0].name,
-            list(filter(lambda b: b.id == cube.quicklook[0].blue, cube.bands))[0].name
-        ]
+        band_names = {b.id: b.name for b in cube.bands}
+        quicklook = cube.quicklook[0]
+        dump_cube['quicklook'] = [band_names[quicklook.red], band_names[quicklook.green], band_names[quicklook.blue]]
         dump_cube['extent'] = None
         dump_cube['grid'] = cube.grs.name
         dump_cube['composite_function'] = cube.composite_function.name
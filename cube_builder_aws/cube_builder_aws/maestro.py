@@ -10,10 +10,12 @@ import json
 import os
 import re
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
 from copy import deepcopy
 from datetime import datetime
+from functools import partial
 from operator import itemgetter
-from pathlib import Path
 
 import numpy
 import rasterio
@@ -22,18 +24,28 @@ from bdc_catalog.models.base_sql import db
 from geoalchemy2 import func
 from rasterio.io import MemoryFile
 from rasterio.transform import Affine
-from rasterio.warp import Resampling, reproject
-
-from .constants import (APPLICATION_ID, CLEAR_OBSERVATION_ATTRIBUTES,
-                        CLEAR_OBSERVATION_NAME, COG_MIME_TYPE,
-                        DATASOURCE_ATTRIBUTES, DATASOURCE_NAME, HARMONIZATION,
-                        PROVENANCE_ATTRIBUTES, PROVENANCE_NAME, SRID_BDC_GRID,
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import Resampling
+from rasterio.windows import Window
+
+from .constants import (APPLICATION_ID, BLEND_MAX_WORKERS,
+                        CLEAR_OBSERVATION_ATTRIBUTES, CLEAR_OBSERVATION_NAME,
+                        COG_MIME_TYPE, DATASOURCE_ATTRIBUTES, DATASOURCE_NAME,
+                        HARMONIZATION, MERGE_BLOCK_SIZE, MERGE_BUFFERED_BLOCKS,
+                        MERGE_MAX_WORKERS, PROVENANCE_ATTRIBUTES,
+                        PROVENANCE_NAME, PUBLISH_ASSET_MAX_WORKERS,
+                        QA_STATISTICS_DECIMATION, QUICKLOOK_PREFETCH,
+                        READ_BLOCK_LINES, SRID_BDC_GRID,
                         TOTAL_OBSERVATION_ATTRIBUTES, TOTAL_OBSERVATION_NAME)
 from .logger import logger
 from .utils.processing import (QAConfidence, apply_landsat_harmonization,
-                               create_asset_definition, create_cog_in_s3,
-                               create_index, encode_key, format_version,
-                               generateQLook, get_qa_mask, qa_statistics)
+                               build_lookup_table, create_asset_definition,
+                               create_cog_in_s3, create_index, encode_key,
+                               format_version, generateQLook,
+                               get_block_windows, get_geom_wgs84, get_qa_mask,
+                               get_read_windows, get_tile_grid, ordered_map,
+                               ordered_stream_map, prefetch_window_reads,
+                               qa_statistics, stack_median)
 from .utils.scene_parser import SceneParser
 from .utils.timeline import Timeline
 
@@ -49,24 +61,34 @@ def orchestrate(cube_irregular_infos, temporal_schema, tiles, start_date, end_da
             GridRefSys.id == Tile.grid_ref_sys_id
         ).all()
 
-    tiles_infos = []
+    # group tile names by grid table to fetch all tile stats in a single query per grid
+    tbl_to_names = dict()
     for tile in tiles_by_grs:
-        grid_table = tile.GridRefSys.geom_table
-        
-        tile_stats = db.session.query(
+        tbl_to_names.setdefault(tile.GridRefSys.id, (tile.GridRefSys.geom_table, []))
+        tbl_to_names[tile.GridRefSys.id][1].append(tile.Tile.name)
+
+    stats_by_tile = dict()
+    for grid_id, (grid_table, tile_names) in tbl_to_names.items():
+        rows = db.session.query(
+            grid_table.c.tile,
             (func.ST_XMin(grid_table.c.geom)).label('min_x'),
             (func.ST_YMax(grid_table.c.geom)).label('max_y'),
             (func.ST_XMax(grid_table.c.geom) - func.ST_XMin(grid_table.c.geom)).label('dist_x'),
             (func.ST_YMax(grid_table.c.geom) - func.ST_YMin(grid_table.c.geom)).label('dist_y'),
-            (func.ST_AsGeoJSON(func.ST_Transform(grid_table.c.geom, 4326))).label('feature')
+            (func.ST_AsGeoJSON(get_geom_wgs84(grid_table))).label('feature')
         ).filter(
-            grid_table.c.tile == tile.Tile.name
-        ).first()
+            grid_table.c.tile.in_(tile_names)
+        ).all()
+
+        for row in rows:
+            stats_by_tile[(grid_id, row.tile)] = row
 
+    tiles_infos = []
+    for tile in tiles_by_grs:
         tiles_infos.append(dict(
             id=tile.Tile.id,
             name=tile.Tile.name,
-            stats=tile_stats
+            stats=stats_by_tile.get((tile.GridRefSys.id, tile.Tile.name))
         ))
 
     # get cube start_date if exists
@@ -78,8 +100,21 @@ def orchestrate(cube_irregular_infos, temporal_schema, tiles, start_date, end_da
     timeline = Timeline(**temporal_schema, start_date=start_date, end_date=end_date).mount()
 
     # create collection items (old model => mosaic)
-    items_id = []
     prefix = '' if item_prefix is None else str(item_prefix)
+
+    # tile properties which does not change between periods
+    tiles_static = {}
+    for tile in tiles_infos:
+        tile_stats = tile['stats']
+        tiles_static[tile['name']] = dict(
+            geom=tile_stats.feature,
+            xmin=tile_stats.min_x,
+            ymax=tile_stats.max_y,
+            dist_x=tile_stats.dist_x,
+            dist_y=tile_stats.dist_y,
+            dirname=f'{os.path.join(prefix, cube_irregular_infos.name, formatted_version, tile["name"])}/'
+        )
+
     items = {}
     for interval in sorted(timeline):
         
@@ -89,40 +124,50 @@ def orchestrate(cube_irregular_infos, temporal_schema, tiles, start_date, end_da
         if start_date is not None and interval_start < start_date : continue
         if end_date is not None and interval_end > end_date : continue
 
+        period = f'{interval_start}_{interval_end}'
+
         for tile in tiles_infos:
             tile_id = tile['id']
             tile_name = tile['name']
-            tile_stats = tile['stats']
-            feature = tile_stats.feature
-
-            items[tile_name] = items.get(tile_name, {})
-            items[tile_name]['geom'] = feature
-            items[tile_name]['xmin'] = tile_stats.min_x
-            items[tile_name]['ymax'] = tile_stats.max_y
-            items[tile_name]['dist_x'] = tile_stats.dist_x
-            items[tile_name]['dist_y'] = tile_stats.dist_y
-            items[tile_name]['periods'] = items[tile_name].get('periods', {})
-
-            period = f'{interval_start}_{interval_end}'
-
-            item_id = f'{cube_irregular_infos.name}_{formatted_version}_{tile_name}_{period}'
-            if item_id not in items_id:
-                items_id.append(item_id)
-                items[tile_name]['periods'][period] = {
-                    'tile_id': tile_id,
-                    'tile_name': tile_name,
-                    'item_date': period,
-                    'id': item_id,
-                    'composite_start': interval_start,
-                    'composite_end': interval_end,
-                    'dirname': f'{os.path.join(prefix, cube_irregular_infos.name, formatted_version, tile_name)}/'
-                }
-                if shape:
-                    items[tile_name]['periods'][period]['shape'] = shape
+            tile_static = tiles_static[tile_name]
+
+            if tile_name not in items:
+                items[tile_name] = {k: v for k, v in tile_static.items() if k != 'dirname'}
+                items[tile_name]['periods'] = {}
+
+            # The item id is unique by tile and period, keep the first one
+            periods = items[tile_name]['periods']
+            if period in periods:
+                continue
+
+            periods[period] = {
+                'tile_id': tile_id,
+                'tile_name': tile_name,
+                'item_date': period,
+                'id': f'{cube_irregular_infos.name}_{formatted_version}_{tile_name}_{period}',
+                'composite_start': interval_start,
+                'composite_end': interval_end,
+                'dirname': tile_static['dirname']
+            }
+            if shape:
+                periods[period]['shape'] = shape
 
     return items
 
 
+def s3_file_listed(services, listings, key, bucket_name=None):
+    """Check if the key exists in the bucket, listing each folder only once.
+
+    The listed keys of each folder are cached in ``listings``, which must be scoped
+    to the caller so a later check does not see an outdated listing.
+    """
+    folder = os.path.dirname(key) + '/'
+    if folder not in listings:
+        listings[folder] = services.list_s3_keys(prefix=folder, bucket_name=bucket_name)
+
+    return key in listings[folder]
+
+
 def get_key_to_controltable(activity):
     activitiesControlTableKey = activity['dynamoKey']
     
@@ -209,12 +254,13 @@ def prepare_harm(self, scenes, bucket_dst, bucket_angles, satellite):
         bucket_angles = bucket_angles
     )
 
+    harm_activities = []
     for scene in scenes:
         scene_infos = p.parser_sceneid(scene, args=dict())
         sat_version = f'L{scene_infos["satellite"]}'
 
         for band in bands[sat_version]:
-            path_file = format_path.format(**dict(band=band, **scene_infos))
+            path_file = format_path.format(band=band, **scene_infos)
 
             path_src = f'{bucket_src}/{path_file}'
             key_path_dst = path_file
@@ -226,9 +272,11 @@ def prepare_harm(self, scenes, bucket_dst, bucket_angles, satellite):
             activity['path_src'] = path_src
             activity['key_path_dst'] = key_path_dst
 
-            # Send to queue to activate harmonization lambda
-            services.put_item_kinesis(activity)
-            services.send_to_sqs(activity)
+            # The activity only holds strings, a shallow copy is enough
+            harm_activities.append(dict(activity))
+
+    # Send to queue to activate harmonization lambda
+    services.dispatch_activities(harm_activities)
 
     return
 
@@ -309,15 +357,16 @@ def prepare_search(self, datacube, irregular_datacube, datasets, satellite, band
     
     activity['bands'] = [band for band in activity['bands'] if band not in activity['internal_bands']]
 
-    activity['stac_list'] = []
-    for stac in services.stac_list:
-        stac_cp = deepcopy(stac)
-        del stac_cp['instance']
-        activity['stac_list'].append(stac_cp)
+    # STAC definitions without the client instance (not serializable)
+    activity['stac_list'] = [
+        {key: value for key, value in stac.items() if key != 'instance'}
+        for stac in services.stac_list
+    ]
 
     logger.info('prepare search - Score {} items'.format(self.score['items']))
 
     scenes_not_started = []
+    search_activities = []
 
     # For all tiles
     for tile_name in self.score['items']:
@@ -332,6 +381,13 @@ def prepare_search(self, datacube, irregular_datacube, datasets, satellite, band
         activity['dist_x'] = self.score['items'][tile_name]['dist_x']
         activity['dist_y'] = self.score['items'][tile_name]['dist_y']
 
+        # Tile raster grid, shared by all merges of the tile
+        num_pixel_x, num_pixel_y, activity['transform'] = get_tile_grid(
+            float(activity['xmin']), float(activity['ymax']), float(activity['dist_x']), float(activity['dist_y']),
+            float(activity['resx']), float(activity['resy'])
+        )
+        activity['tile_shape'] = [num_pixel_x, num_pixel_y]
+
         # For all periods
         for periodkey in self.score['items'][tile_name]['periods']:
             period = self.score['items'][tile_name]['periods'][periodkey]
@@ -345,17 +401,18 @@ def prepare_search(self, datacube, irregular_datacube, datasets, satellite, band
             activity['end'] = activity['end'].strftime('%Y-%m-%d')
             
             # When force is True, we must rebuild the merge
-            search_control_key = encode_key(activity, ['action', 'irregular_datacube', 'tileid', 'start', 'end'])
-            publish_control_key = 'publish{}{}'.format(activity['datacube'], encode_key(activity, ['tileid', 'start', 'end']))
+            tile_period_key = encode_key(activity, ['tileid', 'start', 'end'])
+            search_control_key = encode_key(activity, ['action', 'irregular_datacube']) + tile_period_key
+            publish_control_key = 'publish{}{}'.format(activity['datacube'], tile_period_key)
             if not force:
                 response = services.get_activity_item({'id': publish_control_key, 'sk': 'ALLBANDS' })
                 if 'Item' in response and response['Item']['mystatus'] == 'DONE':
                     scenes_not_started.append(f'{activity["tileid"]}_{activity["start"]}_{activity["end"]}')
                     continue
             else:
-                merge_control_key = 'merge{}'.format(encode_key(activity, ['irregular_datacube', 'tileid', 'start', 'end']))
-                blend_control_key = 'blend{}{}'.format(activity['datacube'], encode_key(activity, ['tileid', 'start', 'end']))
-                posblend_control_key = 'posblend{}{}'.format(activity['datacube'], encode_key(activity, ['tileid', 'start', 'end']))
+                merge_control_key = 'merge{}{}'.format(activity['irregular_datacube'], tile_period_key)
+                blend_control_key = 'blend{}{}'.format(activity['datacube'], tile_period_key)
+                posblend_control_key = 'posblend{}{}'.format(activity['datacube'], tile_period_key)
                 self.services.remove_control_by_key(search_control_key)
                 self.services.remove_control_by_key(merge_control_key)
                 self.services.remove_control_by_key(blend_control_key)
@@ -376,9 +433,11 @@ def prepare_search(self, datacube, irregular_datacube, datasets, satellite, band
             activity['instancesToBeDone'] = 1
             activity['totalInstancesToBeDone'] = 1
             
-            # Send to queue to activate search lambda
-            services.put_item_kinesis(activity)
-            services.send_to_sqs(activity)
+            # Shallow copy: the nested values are either shared read-only or rebuilt for each tile
+            search_activities.append(dict(activity))
+
+    # Send to queue to activate search lambda
+    services.dispatch_activities(search_activities)
 
     return scenes_not_started
 
@@ -435,6 +494,9 @@ def search(self, activity):
                                     datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
 
         # Build each merge activity
+        merge_candidates = []
+        # Key prefix shared by all merges of this tile
+        merge_key_prefix = encode_key(activity_merge, ['action','irregular_datacube','tileid'])
         # For all bands
         for band in scenes:
             activity_merge['band'] = band
@@ -449,7 +511,7 @@ def search(self, activity):
                     activity_merge['links'] = []
 
                     # Create the dynamoKey for the activity in DynamoDB
-                    activity_merge['dynamoKey'] = encode_key(activity_merge, ['action','irregular_datacube','tileid','date','band'])
+                    activity_merge['dynamoKey'] = encode_key(activity_merge, ['date','band'], base=merge_key_prefix)
 
                     # Get all scenes that were acquired in the same date
                     activity_merge['original_band_name'] = dict()
@@ -469,27 +531,37 @@ def search(self, activity):
                     activity_merge['sk'] = activity_merge['date']
                     activity_merge['mylaunch'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-                    # Check if we have already done and no need to do it again
-                    response = services.get_activity_item({'id': activity_merge['dynamoKey'], 'sk': activity_merge['sk'] })
-                    if 'Item' in response:
-                        if not activity.get('force') and response['Item']['mystatus'] == 'DONE' \
-                                and services.s3_file_exists(key=activity_merge['ARDfile']):
-                            # next_step(services, activity)
-                            continue
-                        else:
-                            services.remove_activity_by_key(activity_merge['dynamoKey'], activity_merge['sk'])
-
-                    # Re-schedule a merge-warped
-                    activity_merge['mylaunch'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    activity_merge['mystatus'] = 'NOTDONE'
-                    activity_merge['mystart'] = 'SSSS-SS-SS'
-                    activity_merge['myend'] = 'EEEE-EE-EE'
-                    activity_merge['efficacy'] = '0'
-                    activity_merge['cloudratio'] = '100'
+                    # Shallow copy: links, original_band_name and platforms are rebuilt for each date
+                    merge_candidates.append(dict(activity_merge))
+
+        # Check if we have already done and no need to do it again
+        done_items = services.get_activity_items([dict(id=m['dynamoKey'], sk=m['sk']) for m in merge_candidates])
+        # Merged files found in bucket, listed once for each date folder
+        ard_files = dict()
+
+        merge_activities = []
+        for merge_activity in merge_candidates:
+            item = done_items.get((merge_activity['dynamoKey'], merge_activity['sk']))
+            if item is not None:
+                if not activity.get('force') and item['mystatus'] == 'DONE':
+                    if s3_file_listed(services, ard_files, merge_activity['ARDfile']):
+                        # next_step(services, activity)
+                        continue
 
-                    # Send to queue to activate merge lambda
-                    services.put_item_kinesis(activity_merge)
-                    services.send_to_sqs(activity_merge)
+                services.remove_activity_by_key(merge_activity['dynamoKey'], merge_activity['sk'])
+
+            # Re-schedule a merge-warped
+            merge_activity['mylaunch'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            merge_activity['mystatus'] = 'NOTDONE'
+            merge_activity['mystart'] = 'SSSS-SS-SS'
+            merge_activity['myend'] = 'EEEE-EE-EE'
+            merge_activity['efficacy'] = '0'
+            merge_activity['cloudratio'] = '100'
+
+            merge_activities.append(merge_activity)
+
+        # Send to queue to activate merge lambda
+        services.dispatch_activities(merge_activities)
 
         # Update entry in DynamoDB
         activity['myend'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -508,6 +580,27 @@ def search(self, activity):
 
         logger.error(str(e), exc_info=True)
 
+
+def get_scratch_buffer(self, name, shape, dtype, fill_value):
+    """Get the worker scratch raster of the given name filled with fill_value.
+
+    The raster is only allocated again when the tile shape or the data type changes,
+    avoiding to allocate and fault in a whole tile for each band merged in the same worker.
+
+    The merge workers only run merges, and each merge allocates these rasters anyway, so keeping them
+    does not raise the peak memory of a merge, only the idle footprint of a warm worker: at most 4 bytes
+    by tile pixel (merge, mask and provenance), ~480 MB for a 10980 x 10980 tile, within the 3584 MB merge Lambda.
+    """
+    dtype = numpy.dtype(dtype)
+    buffer = self.scratch_buffers.get(name)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        # Release the previous raster before allocating the new one
+        self.scratch_buffers.pop(name, None)
+        buffer = self.scratch_buffers[name] = numpy.empty(shape, dtype=dtype)
+    buffer.fill(fill_value)
+    return buffer
+
+
 def merge_warped(self, activity):
     logger.info('==> start MERGE')
     services = self.services
@@ -561,11 +654,15 @@ def merge_warped(self, activity):
                 if is_quality_band:
                     file_path = '{}{}'.format(prefix, key)
                     with rasterio.open(file_path) as src:
-                        values = src.read(1)
+                        # Statistics are computed on a decimated read, served by the COG overviews
+                        out_shape = (max(1, src.height // QA_STATISTICS_DECIMATION),
+                                     max(1, src.width // QA_STATISTICS_DECIMATION))
+                        values = src.read(1, out_shape=out_shape, resampling=Resampling.nearest)
 
                         if build_provenance:
                             with rasterio.open(file_path.replace(f'_{band}', f'_{DATASOURCE_NAME}')) as ds_provenance:
-                                raster_provenance = ds_provenance.read(1)
+                                raster_provenance = ds_provenance.read(1, out_shape=out_shape,
+                                                                      resampling=Resampling.nearest)
                                 provenance_valid = raster_provenance[raster_provenance != DATASOURCE_ATTRIBUTES['nodata']]
 
                                 unique, counts = numpy.unique(provenance_valid, return_counts=True)
@@ -579,7 +676,7 @@ def merge_warped(self, activity):
                                 confidence.landsat_8 = raster_provenance == index_landsat
 
                         efficacy, cloudratio = qa_statistics(values, mask=activity_mask, 
-                                                             blocks=list(src.block_windows()),
+                                                             blocks=[(0, Window(0, 0, out_shape[1], out_shape[0]))],
                                                              confidence=confidence)
 
                 # Update entry in DynamoDB
@@ -593,12 +690,6 @@ def merge_warped(self, activity):
                 _ = services.delete_file_S3(bucket_name=bucket_name, key=key)
 
         # Lets warp and merge
-        resx = float(activity['resx'])
-        resy = float(activity['resy'])
-        xmin = float(activity['xmin'])
-        ymax = float(activity['ymax'])
-        dist_x = float(activity['dist_x'])
-        dist_y = float(activity['dist_y'])
         nodata = int(activity['quality_nodata']) if is_quality_band else int(activity['nodata'])
 
         shape = activity.get('shape', None)
@@ -607,13 +698,20 @@ def merge_warped(self, activity):
             num_pixel_y = shape[1]
 
         else:
-            num_pixel_x = round(dist_x / resx)
-            num_pixel_y = round(dist_y / resy)
+            if activity.get('transform'):
+                num_pixel_x, num_pixel_y = activity['tile_shape']
+                transform_coefficients = activity['transform']
+            else:
+                # Activities dispatched without the tile grid
+                num_pixel_x, num_pixel_y, transform_coefficients = get_tile_grid(
+                    float(activity['xmin']), float(activity['ymax']), float(activity['dist_x']),
+                    float(activity['dist_y']), float(activity['resx']), float(activity['resy'])
+                )
 
-            new_res_x = dist_x / num_pixel_x
-            new_res_y = dist_y / num_pixel_y
+            transform = Affine(*transform_coefficients)
 
-            transform = Affine(new_res_x, 0, xmin, 0, -new_res_y, ymax)
+            new_res_x = transform.a
+            new_res_y = -transform.e
 
         numcol = num_pixel_x
         numlin = num_pixel_y
@@ -628,17 +726,23 @@ def merge_warped(self, activity):
 
             source_nodata = source_nodata if activity.get('source_nodata') else activity_mask['nodata']
 
-            raster = numpy.zeros((numlin, numcol,), dtype=numpy.uint16)
-            raster_merge = numpy.full((numlin, numcol,), dtype=numpy.uint16, fill_value=source_nodata)
-            raster_mask = numpy.ones((numlin, numcol,), dtype=numpy.uint16)
+            raster_dtype = numpy.uint16
+            raster_merge = get_scratch_buffer(self, 'merge', (numlin, numcol,), numpy.uint16, source_nodata)
+            # Pixels which were not filled by any scene yet
+            raster_mask = get_scratch_buffer(self, 'mask', (numlin, numcol,), numpy.bool_, True)
             
             if build_provenance:
-                raster_provenance = numpy.full((numlin, numcol,), dtype=numpy.uint8, fill_value=DATASOURCE_ATTRIBUTES['nodata'])
+                raster_provenance = get_scratch_buffer(self, 'provenance', (numlin, numcol,), numpy.uint8,
+                                                       DATASOURCE_ATTRIBUTES['nodata'])
         
         else:
             resampling = Resampling.bilinear
-            raster = numpy.zeros((numlin, numcol,), dtype=numpy.int16)
-            raster_merge = numpy.full((numlin, numcol,), fill_value=nodata, dtype=numpy.int16)
+            raster_dtype = numpy.int16
+            raster_merge = get_scratch_buffer(self, 'merge', (numlin, numcol,), numpy.int16, nodata)
+
+        # Merge blocks and their slices, shared by all scenes
+        merge_windows = list(get_block_windows(numcol, numlin, block_size=MERGE_BLOCK_SIZE))
+        merge_window_slices = [window.toslices() for window in merge_windows]
 
         # For all files
         template = None
@@ -661,7 +765,13 @@ def merge_warped(self, activity):
                     'transform': transform
                 })
 
-        for url in activity['links']:
+        from rasterio.session import AWSSession
+
+        aws_session = AWSSession(services.session, requester_pays=True)
+        scene_source_nodata = source_nodata
+
+        def read_warped_scene(url):
+            """Yield the profile to write the scene band, then its blocks warped to the tile grid."""
             new_url = url
             if landsat_harmonization:
                 if not is_quality_band:
@@ -670,10 +780,10 @@ def merge_warped(self, activity):
                         bucket_src = HARMONIZATION['landsat']['bucket_src'].replace('s3://', '')
                         new_url = new_url.replace(bucket_src, landsat_harmonization['bucket_dst'])
 
-            from rasterio.session import AWSSession
+            source_nodata = scene_source_nodata
 
-            aws_session = AWSSession(services.session, requester_pays=True)
-            with rasterio.Env(aws_session, AWS_SESSION_TOKEN=""):
+            with rasterio.Env(aws_session, AWS_SESSION_TOKEN="", CPL_VSIL_CURL_USE_HEAD='NO',
+                              GDAL_HTTP_MERGE_CONSECUTIVE_RANGES='YES'):
 
                 with rasterio.open(new_url) as src:
 
@@ -711,55 +821,71 @@ def merge_warped(self, activity):
                             'tiled': True
                         })
 
-                    with MemoryFile() as memfile:
-                        with memfile.open(**kwargs) as dst:
-                            if shape:
-                                raster = src.read(1)
-                            else:
-                                reproject(
-                                    source=rasterio.band(src, 1),
-                                    destination=raster,
-                                    src_transform=src.transform,
-                                    src_crs=src.crs,
-                                    dst_transform=transform,
-                                    dst_crs=activity['srs'],
-                                    src_nodata=source_nodata,
-                                    dst_nodata=nodata,
-                                    resampling=resampling)
+                    yield kwargs
 
-                            if not is_quality_band or is_sentinel_landsat_quality_fmask:
-                                valid_data_scene = raster[raster != nodata]
-                                raster_merge[raster != nodata] = valid_data_scene.reshape(numpy.size(valid_data_scene))
+                    # When the scene is not aligned with the tile grid, GDAL warps it on demand through a VRT
+                    if shape:
+                        data_source = nullcontext(src)
+                    else:
+                        data_source = WarpedVRT(src,
+                                                crs=activity['srs'],
+                                                transform=transform,
+                                                width=numcol,
+                                                height=numlin,
+                                                src_nodata=source_nodata,
+                                                nodata=nodata,
+                                                dtype=raster_dtype,
+                                                resampling=resampling)
+
+                    # Warp and read block by block to keep only a few blocks of the scene in memory
+                    with data_source as scene:
+                        for window, window_slices in zip(merge_windows, merge_window_slices):
+                            yield window_slices, scene.read(1, window=window)
+
+        # Scenes are downloaded and warped concurrently, but merged in the links order. Each scene holds
+        # at most MERGE_BUFFERED_BLOCKS blocks read ahead, instead of a whole tile
+        with ThreadPoolExecutor(max_workers=MERGE_MAX_WORKERS) as executor, \
+                closing(ordered_stream_map(executor, read_warped_scene, activity['links'],
+                                           MERGE_BUFFERED_BLOCKS)) as warped_scenes:
+
+            for url, scene_items in zip(activity['links'], warped_scenes):
+                if build_provenance:
+                    dataset_index = datasets.index(platforms[url])
 
-                                valid_data_scene = None
-                            else:
-                                factor = raster * raster_mask
-                                raster_merge = raster_merge + factor
+                kwargs = next(scene_items)
 
-                                raster_mask[raster != nodata] = 0
+                if template is None:
+                    with MemoryFile() as memfile:
+                        with memfile.open(**kwargs) as dst:
+                            template = dst.profile
 
-                            if build_provenance:
-                                raster_masked = numpy.ma.masked_where(raster == nodata, raster)
+                            template['driver'] = 'GTiff'
 
-                                where_valid = numpy.invert(raster_masked.mask)
-                                raster_provenance[where_valid] = datasets.index(platforms[url])
+                            raster_blocks = list(dst.block_windows())
 
-                                where_valid = None
-                                raster_masked = None
+                            if not is_quality_band:
+                                template.update({'dtype': 'int16'})
+                                template['nodata'] = nodata
 
-                            if template is None:
-                                template = dst.profile
+                # Merge block by block to keep the temporary masks small
+                for window_slices, block_raster in scene_items:
+                    valid_data_mask = block_raster != nodata
+                    block_merge = raster_merge[window_slices]
 
-                                template['driver'] = 'GTiff'
+                    if not is_quality_band or is_sentinel_landsat_quality_fmask:
+                        numpy.copyto(block_merge, block_raster, casting='unsafe', where=valid_data_mask)
+                    else:
+                        block_mask = raster_mask[window_slices]
+                        numpy.add(block_merge, block_raster, out=block_merge, casting='unsafe', where=block_mask)
 
-                                raster_blocks = list(dst.block_windows())
+                        block_mask[valid_data_mask] = False
 
-                                if not is_quality_band:
-                                    template.update({'dtype': 'int16'})
-                                    template['nodata'] = nodata
+                    if build_provenance:
+                        raster_provenance[window_slices][valid_data_mask] = dataset_index
 
+                    valid_data_mask = None
+                    block_raster = None
 
-        raster = None
         raster_mask = None
 
         if build_provenance:
@@ -868,6 +994,9 @@ def next_blend(services, mergeactivity):
         return False
 
     # Fill the blendactivity fields with data for the other bands from the DynamoDB merge records
+    blend_activities = []
+    # Blended files found in bucket, listed once for each composite folder
+    blend_files = dict()
     for band in (blendactivity['bands'] + blendactivity['internal_bands']):
         # if internal process, duplique first band and set the process in activity
         internal_band = band if band in blendactivity['internal_bands'] else False
@@ -888,7 +1017,8 @@ def next_blend(services, mergeactivity):
             exists = True
             for func in blendactivity['functions']:
                 if func == 'IDT' or (func == 'MED' and internal_band == 'PROVENANCE'): continue
-                if not services.s3_file_exists(bucket_name=mergeactivity['bucket_name'], key=blendactivity['{}file'.format(func)]):
+                if not s3_file_listed(services, blend_files, blendactivity['{}file'.format(func)],
+                                      bucket_name=mergeactivity['bucket_name']):
                     exists = False
 
             if not blendactivity.get('force') \
@@ -908,16 +1038,34 @@ def next_blend(services, mergeactivity):
         blendactivity['cloudratio'] = '100'
         blendactivity['mylaunch'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-        services.put_item_kinesis(blendactivity)
-        services.send_to_sqs(blendactivity)
+        blend_activities.append(deepcopy(blendactivity))
 
         # Leave room for next band in blendactivity
         for date_ref in blendactivity['scenes']:
             if band in blendactivity['scenes'][date_ref]['ARDfiles'] \
                 and band != mergeactivity['quality_band']:
                 del blendactivity['scenes'][date_ref]['ARDfiles'][band]
+
+    # Send to queue to activate blend lambda
+    services.dispatch_activities(blend_activities)
     return True
 
+def get_merge_attributes(item):
+    """Retrieve the merge properties used by blend from a DynamoDB activity record.
+
+    Records written before these properties were stored as item attributes
+    are read from the activity JSON.
+    """
+    if 'ard_file' not in item:
+        return json.loads(item['activity'])
+
+    return dict(
+        date=item['scene_date'],
+        satellite=item['satellite'],
+        platform=item.get('platform'),
+        ARDfile=item['ard_file']
+    )
+
 def fill_blend(services, mergeactivity, blendactivity, internal_band=False):
     # Fill blend activity fields with data for band from the DynamoDB merge records
     band = blendactivity['band']
@@ -925,25 +1073,32 @@ def fill_blend(services, mergeactivity, blendactivity, internal_band=False):
 
     cube_version = blendactivity['version']
 
+    # verify if internal process
+    if internal_band:
+        blendactivity['internal_band'] = internal_band
+
     # Query dynamoDB to get all merged
-    items = []
+    merge_key_prefix = encode_key(mergeactivity, ['action','irregular_datacube','tileid'])
+    merge_keys = []
     for date in mergeactivity['list_dates']:
         mergeactivity['date_formated'] = date
 
-        # verify if internal process
-        if internal_band:
-            blendactivity['internal_band'] = internal_band
-        dynamoKey = encode_key(mergeactivity, ['action','irregular_datacube','tileid','date_formated','band'])
-        
-        response = services.get_activities_by_key(dynamoKey)
-        if 'Items' not in response or len(response['Items']) == 0:
+        dynamoKey = encode_key(mergeactivity, ['date_formated','band'], base=merge_key_prefix)
+        merge_keys.append(dict(id=dynamoKey, sk=date[0:10]))
+
+    merge_items = services.get_activity_items(merge_keys)
+
+    items = []
+    for merge_key in merge_keys:
+        item = merge_items.get((merge_key['id'], merge_key['sk']))
+        if item is None:
             return False
-        items += response['Items']
+        items.append(item)
 
     for item in items:
         if item['mystatus'] != 'DONE':
             return False
-        activity = json.loads(item['activity'])
+        activity = get_merge_attributes(item)
         date_ref = item['sk']
         if date_ref not in blendactivity['scenes']:
             blendactivity['scenes'][date_ref] = {}
@@ -1015,18 +1170,6 @@ def blend(self, activity):
             return
 
     try:
-        # Get basic information (profile) of input files
-        keys = list(activity['scenes'].keys())
-        filename = os.path.join(
-            prefix + activity['dirname'],
-            activity['scenes'][keys[0]]['date'],
-            activity['scenes'][keys[0]]['ARDfiles'][band])
-
-        tilelist = None
-        with rasterio.open(filename) as src:
-            profile = src.profile
-            tilelist = list(src.block_windows())
-
         mask_tuples = []
         if is_landsat_harmonization:
             # Images of Landsat 7 after 2003/05/31 have problems
@@ -1044,7 +1187,7 @@ def blend(self, activity):
 
                 platform = re.sub('[_-]', '', scene['platform']) if scene.get('platform') else ''
                 if platform.lower() in ['landsat7', 'l7', 'le07', 'le7'] and \
-                    datetime.strptime(scene['date'][:10], '%Y-%m-%d') < datetime(2003,5,31):
+                    datetime.fromisoformat(scene['date'][:10]) < datetime(2003,5,31):
                     scenes_l7_with_problem.append(mask_tuple)
                 else:
                     scenes_others.append(mask_tuple)
@@ -1061,11 +1204,15 @@ def blend(self, activity):
 
             mask_tuples = sorted(mask_tuples, reverse=True)
 
-        provenance_merge_map = dict()
         build_provenance = activity.get('internal_band') == PROVENANCE_NAME
         build_clear_observation = activity.get('internal_band') == CLEAR_OBSERVATION_NAME
         build_total_observation = activity.get('internal_band') == TOTAL_OBSERVATION_NAME
         build_datasource = activity.get('internal_band') == DATASOURCE_NAME
+        build_median = 'MED' in activity['functions']
+        # The count of valid observations is only used by the median and the clear observation
+        build_valid_count = build_median or build_clear_observation
+        # Without the bands which count every scene, a window is done when all pixels are filled
+        stop_filled_window = not (build_valid_count or build_total_observation)
 
         # Open all input files and save the datasets in two lists, one for masks and other for the current band.
         # The list will be ordered by efficacy/resolution
@@ -1089,12 +1236,10 @@ def blend(self, activity):
                 masklist.append(rasterio.open(filename))
 
                 # build datasource
-                provenance_merge_map.setdefault(key, None)
                 if is_landsat_harmonization:
                     datasource_key = filename.replace(f'_{activity["quality_band"]}.tif', f'_{DATASOURCE_NAME}.tif')
 
                     provenancelist.append(rasterio.open(datasource_key))
-                    provenance_merge_map[key] = rasterio.open(datasource_key)
 
             except:
                 activity['mystatus'] = 'ERROR'
@@ -1122,6 +1267,11 @@ def blend(self, activity):
                 services.put_item_kinesis(activity)
                 return
 
+        # Get basic information (profile) of input files from the already opened band.
+        # Striped inputs are read in groups of lines instead of line by line
+        profile = bandlist[0].profile
+        tilelist = list(enumerate(get_read_windows(bandlist[0], block_lines=READ_BLOCK_LINES)))
+
         # Build the raster to store the output images.
         width = profile['width']
         height = profile['height']
@@ -1129,6 +1279,32 @@ def blend(self, activity):
         clear_values = numpy.array(activity_mask['clear_data'])
         not_clear_values = numpy.array(activity_mask['not_clear_data'])
         saturated_values = numpy.array(activity_mask['saturated_data'])
+        # Values masked in the quality band when it is not bitwise
+        masked_values = numpy.union1d(not_clear_values, saturated_values)
+
+        # Quality values of 8 and 16 bits are classified by lookup tables
+        quality_lookup = all(numpy.dtype(msrc.dtypes[0]) in (numpy.uint8, numpy.uint16) for msrc in masklist)
+
+        # The mask builder of the scene blocks (True => nodata) is chosen once for the activity
+        if activity_mask.get('bits'):
+            def build_scene_mask(raster, quality, quality_nodata_mask):
+                masked = numpy.ma.masked_array(quality, mask=quality_nodata_mask)
+                matched = get_qa_mask(masked, clear_data=clear_values, not_clear_data=not_clear_values,
+                                      nodata=activity_mask['nodata'], confidence=confidence)
+                return matched.mask
+        elif quality_lookup:
+            masked_table = build_lookup_table(masked_values)
+            not_clear_table = numpy.invert(build_lookup_table(clear_values))
+
+            def build_scene_mask(raster, quality, quality_nodata_mask):
+                # Mask cloud/snow/shadow/saturated and the raster no data (-9999 maybe) as True,
+                # except the valid data (0 and 1), in a single expression
+                return (quality_nodata_mask | masked_table[quality] | (raster == nodata)) & \
+                       not_clear_table[quality]
+        else:
+            def build_scene_mask(raster, quality, quality_nodata_mask):
+                return (quality_nodata_mask | numpy.isin(quality, masked_values) | (raster == nodata)) & \
+                       numpy.invert(numpy.isin(quality, clear_values))
 
         # STACK and MED will be generated in memory
         stack_raster = numpy.full((height, width), dtype=profile['dtype'], fill_value=nodata)
@@ -1139,13 +1315,9 @@ def blend(self, activity):
         if build_total_observation:
             stack_total_observation = numpy.zeros((height, width), dtype=numpy.uint8)
 
-        # create file to save clear observation, total oberservation and provenance
+        # Build the clear observation, filled by the count of valid observations of each window
         if build_clear_observation:
-            clear_ob_file = '/tmp/clearob.tif'
-            clear_ob_profile = profile.copy()
-            clear_ob_profile['dtype'] = CLEAR_OBSERVATION_ATTRIBUTES['data_type']
-            clear_ob_profile.pop('nodata', None)
-            clear_ob_dataset = rasterio.open(clear_ob_file, mode='w', **clear_ob_profile)
+            clear_observation = numpy.zeros((height, width), dtype=CLEAR_OBSERVATION_ATTRIBUTES['data_type'])
 
         # Build the provenance
         if build_provenance:
@@ -1167,133 +1339,115 @@ def blend(self, activity):
                                               fill_value=DATASOURCE_ATTRIBUTES['nodata'],
                                               dtype=DATASOURCE_ATTRIBUTES['data_type']), indexes=1)
 
-        for _, window in tilelist:
-            # Build the stack to store all images as a masked array. At this stage the array will contain the masked data
-            stackMA = numpy.ma.zeros((numscenes, window.height, window.width), dtype=numpy.int16)
-
-            notdonemask = numpy.ones(shape=(window.height, window.width), dtype=numpy.bool_)
-
+        # Read functions of the band, quality and datasource of each scene
+        scene_readers = []
+        for order in range(numscenes):
+            readers = [partial(bandlist[order].read, 1), partial(masklist[order].read, 1)]
             if is_landsat_harmonization:
-                data_set_block = numpy.full((window.height, window.width),
-                                        fill_value=DATASOURCE_ATTRIBUTES['nodata'],
-                                        dtype=DATASOURCE_ATTRIBUTES['data_type'])
+                readers.append(partial(provenancelist[order].read, 1))
 
-            row_offset = window.row_off + window.height
-            col_offset = window.col_off + window.width
+            scene_readers.append(readers)
 
-            # For all pair (quality,band) scenes
-            for order in range(numscenes):
-                # Read both chunk of Merge and Quality, respectively.
-                ssrc = bandlist[order]
-                msrc = masklist[order]
-                raster = ssrc.read(1, window=window)
-                masked = msrc.read(1, window=window, masked=True)
+        # Quality nodata of each scene, used to mask the quality as a masked read would
+        quality_nodata = [msrc.nodata for msrc in masklist]
 
-                if is_landsat_harmonization:
-                    psrc = provenancelist[order]
-                    raster_merge_provance = psrc.read(1, window=window)
-                    confidence.landsat_8 = raster_merge_provance == index_landsat
+        # Fill value of the masked data in the median stack
+        median_fill = numpy.iinfo(numpy.int16).max
 
-                if build_total_observation:
-                    copy_mask = numpy.array(masked, copy=True)
+        # Day of year of each observation, used as provenance
+        days_of_year = [datetime.fromisoformat(date).timetuple().tm_yday for date in dates]
 
-                if activity_mask.get('bits'):
-                    matched = get_qa_mask(masked, clear_data=clear_values, not_clear_data=not_clear_values,
-                                          nodata=activity_mask['nodata'], confidence=confidence)
-                    masked.mask = matched.mask
-                else:
-                    # Mask cloud/snow/shadow/no-data as False
-                    masked.mask[numpy.where(numpy.isin(masked, not_clear_values))] = True
-                    # Ensure that Raster no data value (-9999 maybe) is set to False
-                    masked.mask[raster == nodata] = True
-                    masked.mask[numpy.where(numpy.isin(masked, saturated_values))] = True
-                    # Mask valid data (0 and 1) as True
-                    masked.mask[numpy.where(numpy.isin(masked, clear_values))] = False
+        # The scenes of the next window are read while the current window is processed
+        windows = [window for _, window in tilelist]
+        with closing(prefetch_window_reads(scene_readers, windows, max_workers=BLEND_MAX_WORKERS)) as window_blocks:
+            for window, scene_blocks in zip(windows, window_blocks):
+                # Build the stack to store all images for median. The masked data is filled with the dtype maximum
+                if build_median:
+                    median_stack = numpy.empty((numscenes, window.height, window.width), dtype=numpy.int16)
 
-                # Create an inverse mask value in order to pass to numpy masked array
-                # True => nodata
-                bmask = masked.mask
+                # Number of valid observations by pixel
+                if build_valid_count:
+                    valid_count = numpy.zeros((window.height, window.width), dtype=numpy.uint16)
 
-                # Use the mask to mark the fill (0) and cloudy (2) pixels
-                stackMA[order] = numpy.ma.masked_where(bmask, raster)
-
-                if build_total_observation:
-                    # Copy Masked values in order to stack total observation
-                    copy_mask[raster != nodata] = 1
-                    copy_mask[raster == nodata] = 0
+                notdonemask = numpy.ones(shape=(window.height, window.width), dtype=numpy.bool_)
 
-                    stack_total_observation[window.row_off: row_offset, window.col_off: col_offset] += copy_mask.astype(numpy.uint8)
-
-                # Get current observation file name
-                if build_provenance or is_landsat_harmonization:
-                    file_date = datetime.strptime(dates[order], '%Y-%m-%d')
-                    day_of_year = file_date.timetuple().tm_yday
+                if is_landsat_harmonization:
+                    data_set_block = numpy.full((window.height, window.width),
+                                            fill_value=DATASOURCE_ATTRIBUTES['nodata'],
+                                            dtype=DATASOURCE_ATTRIBUTES['data_type'])
 
-                # Find all no data in destination STACK image
-                stack_raster_where_nodata = numpy.where(
-                    stack_raster[window.row_off: row_offset, window.col_off: col_offset] == nodata
-                )
+                # Views of the output rasters in the window
+                window_slices = window.toslices()
+                stack_block = stack_raster[window_slices]
+                if build_total_observation:
+                    total_observation_block = stack_total_observation[window_slices]
+                if build_provenance:
+                    provenance_block = provenance_array[window_slices]
 
-                # Turns into a 1-dimension
-                stack_raster_nodata_pos = numpy.ravel_multi_index(
-                    stack_raster_where_nodata,
-                    stack_raster[window.row_off: row_offset, window.col_off: col_offset].shape
-                )
+                # For all pair (quality,band) scenes
+                for order in range(numscenes):
+                    # Chunk of Merge, Quality and Datasource, respectively.
+                    raster, quality = scene_blocks[order][:2]
 
-                if is_landsat_harmonization:
-                    datasource_block = provenance_merge_map[file_date.strftime('%Y-%m-%d')].read(1, window=window)
+                    if is_landsat_harmonization:
+                        datasource_block = scene_blocks[order][2]
+                        confidence.landsat_8 = datasource_block == index_landsat
 
-                # Find all valid/cloud in destination STACK image
-                raster_where_data = numpy.where(raster != nodata)
-                raster_data_pos = numpy.ravel_multi_index(raster_where_data, raster.shape)
+                    # Quality without data
+                    if quality_nodata[order] is not None:
+                        quality_nodata_mask = quality == quality_nodata[order]
+                    else:
+                        quality_nodata_mask = numpy.zeros(quality.shape, dtype=numpy.bool_)
 
-                # Match stack nodata values with observation
-                # stack_raster_where_nodata && raster_where_data
-                intersect_ravel = numpy.intersect1d(stack_raster_nodata_pos, raster_data_pos)
+                    # Build the mask of the scene: True => nodata
+                    bmask = build_scene_mask(raster, quality, quality_nodata_mask)
 
-                if len(intersect_ravel):
-                    where_intersec = numpy.unravel_index(intersect_ravel, raster.shape)
-                    stack_raster[window.row_off: row_offset, window.col_off: col_offset][where_intersec] = raster[where_intersec]
+                    # Use the mask to mark the fill (0) and cloudy (2) pixels
+                    valid_mask = numpy.invert(bmask)
+                    if build_valid_count:
+                        valid_count += valid_mask
 
-                    if build_provenance:
-                        provenance_array[window.row_off: row_offset, window.col_off: col_offset][where_intersec] = day_of_year
+                    if build_median:
+                        median_stack[order].fill(median_fill)
+                        numpy.copyto(median_stack[order], raster, casting='unsafe', where=valid_mask)
 
-                    if is_landsat_harmonization:
-                        data_set_block[where_intersec] = datasource_block[where_intersec]
+                    raster_valid = raster != nodata
 
-                # Identify what is needed to stack, based in Array 2d bool
-                todomask = notdonemask * numpy.invert(bmask)
+                    if build_total_observation:
+                        # Count the observations with data
+                        total_observation_block += raster_valid
 
-                # Find all positions where valid data matches.
-                clear_not_done_pixels = numpy.where(numpy.logical_and(todomask, numpy.invert(masked.mask)))
+                    # Pixels to override in the STACK: the no data of STACK which have observation
+                    # and the valid data not done yet. Both take the raster value, so they are written at once
+                    stack_pixels = (stack_block == nodata) & raster_valid
+                    stack_pixels |= notdonemask & valid_mask
 
-                # Override the STACK Raster with valid data.
-                stack_raster[window.row_off: row_offset, window.col_off: col_offset][clear_not_done_pixels] = raster[
-                    clear_not_done_pixels]
+                    numpy.copyto(stack_block, raster, casting='unsafe', where=stack_pixels)
 
-                if build_provenance:
-                    # Mark day of year to the valid pixels
-                    provenance_array[window.row_off: row_offset, window.col_off: col_offset][
-                        clear_not_done_pixels] = day_of_year
+                    if build_provenance:
+                        # Mark day of year to the stacked pixels
+                        numpy.copyto(provenance_block, days_of_year[order], casting='unsafe', where=stack_pixels)
 
-                if is_landsat_harmonization:
-                    data_set_block[clear_not_done_pixels] = datasource_block[clear_not_done_pixels]
+                    if is_landsat_harmonization:
+                        numpy.copyto(data_set_block, datasource_block, casting='unsafe', where=stack_pixels)
 
-                # Update what was done.
-                notdonemask = notdonemask * bmask
+                    # Update what was done.
+                    notdonemask &= bmask
 
-            if 'MED' in activity['functions']:
-                median = numpy.ma.median(stackMA, axis=0).data
-                median[notdonemask.astype(numpy.bool_)] = nodata
-                median_raster[window.row_off: row_offset, window.col_off: col_offset] = median.astype(profile['dtype'])
+                    # The next scenes can not change a window with valid data and no STACK nodata
+                    if stop_filled_window and not notdonemask.any() and not (stack_block == nodata).any():
+                        break
 
-            if build_clear_observation:
-                count_raster = numpy.ma.count(stackMA, axis=0)
+                if build_median:
+                    median = stack_median(median_stack, valid_count)
+                    # MED raster is filled with nodata, so only the pixels with observation are written
+                    numpy.copyto(median_raster[window_slices], median, casting='unsafe', where=numpy.invert(notdonemask))
 
-                clear_ob_dataset.write(count_raster.astype(clear_ob_profile['dtype']), window=window, indexes=1)
+                if build_clear_observation:
+                    numpy.copyto(clear_observation[window_slices], valid_count, casting='unsafe')
 
-            if build_datasource:
-                datasource_dataset.write(data_set_block, window=window, indexes=1)
+                if build_datasource:
+                    datasource_dataset.write(data_set_block, window=window, indexes=1)
 
         # Close all input dataset
         for order in range(numscenes):
@@ -1328,13 +1482,14 @@ def blend(self, activity):
 
         # Upload the CLEAROB dataset
         if build_clear_observation:
-            clear_ob_dataset.close()
-            clear_ob_dataset = None
+            clear_ob_profile = profile.copy()
+            clear_ob_profile.pop('nodata', None)
+            clear_ob_profile['dtype'] = CLEAR_OBSERVATION_ATTRIBUTES['data_type']
             for func in activity['functions']:
                 if func == 'IDT': continue
                 key_clearob = activity['{}file'.format(func)].replace(f'_{band}.tif', f'_{CLEAR_OBSERVATION_NAME}.tif')
-                services.upload_file_S3(clear_ob_file, key_clearob, {'ACL': 'public-read'}, bucket_name=bucket_name)
-            os.remove(clear_ob_file)
+                create_cog_in_s3(
+                    services, clear_ob_profile, key_clearob, clear_observation, bucket_name)
 
         if 'STK' in activity['functions']:
             # Upload the PROVENANCE dataset
@@ -1456,6 +1611,7 @@ def next_posblend(services, blendactivity):
                 else:
                     posblendactivity['indexesToBe'][i_name][func][band_name] = activity['{}file'.format(func)]
 
+    posblend_activities = []
     for i_name in posblendactivity['bands_expressions'].keys():
         # create and dispatch one activity to irregular cube and one to regular cubes (each index)
 
@@ -1488,11 +1644,12 @@ def next_posblend(services, blendactivity):
                     date = scene['date']
                     posblendactivity['sk'] = '{}{}{}'.format(i_name, i, date)
             
-                    services.put_item_kinesis(posblendactivity)
-                    services.send_to_sqs(posblendactivity)
+                    posblend_activities.append(deepcopy(posblendactivity))
             else:
-                services.put_item_kinesis(posblendactivity)
-                services.send_to_sqs(posblendactivity)
+                posblend_activities.append(deepcopy(posblendactivity))
+
+    # Send to queue to activate posblend lambda
+    services.dispatch_activities(posblend_activities)
 
     return True
 
@@ -1679,8 +1836,7 @@ def next_publish(services, posblendactivity):
             services.remove_activity_by_key(publishactivity['dynamoKey'], 'ALLBANDS')
 
     # Launch activity
-    services.put_item_kinesis(publishactivity)
-    services.send_to_sqs(publishactivity)
+    services.dispatch_activities([publishactivity])
 
 def publish(self, activity):
     logger.info('==> start PUBLISH')
@@ -1693,99 +1849,132 @@ def publish(self, activity):
 
     srid = SRID_BDC_GRID
 
-    activity['mystart'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    def upload_quicklook(png, key):
+        services.upload_fileobj_S3(png, key, {'ACL': 'public-read'}, bucket_name=bucket_name)
+
+    def describe_band_asset(relative_path, compute_geom):
+        full_path = f'{bucket_name}/{relative_path}'
+        return create_asset_definition(services, bucket_name, relative_path, COG_MIME_TYPE, ['data'],
+                                       full_path, is_raster=True, compute_geom=compute_geom)
+
+    def describe_band_assets(item, band_paths):
+        # The band assets are described concurrently. The bands share the same footprint,
+        # so only the geometry of the last band is computed and kept by the item
+        assets = dict()
+        paths = list(band_paths.values())
+        compute_geoms = [order == len(paths) - 1 for order in range(len(paths))]
+        definitions = list(describer.map(describe_band_asset, paths, compute_geoms))
+        for band_name, (asset, _, _) in zip(band_paths, definitions):
+            assets[band_name] = asset
+        if definitions:
+            _, item.geom, item.min_convex_hull = definitions[-1]
+        return assets
+
+    uploader = ThreadPoolExecutor(max_workers=1)
+    generator = ThreadPoolExecutor(max_workers=1)
+    describer = ThreadPoolExecutor(max_workers=PUBLISH_ASSET_MAX_WORKERS)
+
+    # Start time of the activity, also used as update time of its items
+    now = datetime.now()
+    activity['mystart'] = now.strftime('%Y-%m-%d %H:%M:%S')
     try:
         identity_cube = activity['irregular_datacube']
 
+        # Items created or updated by the activity
+        published_items = []
+
         # GENERATE QUICKLOOK's and REGISTER ITEMS in DB
         ## for CUBES (MEDIAN, STACK ...)
         qlbands = activity['quicklook']
-        for function in activity['functions']:
-            if function == 'IDT': continue
-
+        # Version of the composite and identity cubes of the activity
+        collection_version = int(activity['version'][-3:])
+        functions = [function for function in activity['functions'] if function != 'IDT']
+        if functions:
+            # The cube, its bands and the tile are the same for every function
             cube_name = activity['datacube']
             cube = Collection.query().filter(
                 Collection.name == cube_name,
-                Collection.version == int(activity['version'][-3:])
+                Collection.version == collection_version
             ).first()
             if not cube:
                 raise Exception(f'cube {cube_name} - {activity["version"]} not found!')
 
-            general_scene_id = '{}_{}_{}_{}_{}'.format(
-                cube_name, activity['version'], activity['tileid'], activity['start'], activity['end'])
-
             srid = cube.grs.geom_table.columns.geom.type.srid
 
+            bands_by_cube = {
+                str(band_model.name): band_model
+                for band_model in Band.query().filter(Band.collection_id == cube.id).all()
+            }
+
+            tile = Tile.query().filter(
+                Tile.name == activity['tileid'],
+                Tile.grid_ref_sys_id == cube.grid_ref_sys_id
+            ).first()
+
+            general_scene_id = f"{cube_name}_{activity['version']}_{activity['tileid']}_{activity['start']}_{activity['end']}"
+
+            # The item is shared by the functions, it is fetched once and created by the first one
+            item = Item.query().filter(
+                Item.name == general_scene_id,
+                Item.collection_id == cube.id).first()
+
+            indexes_list = list(activity['indexesToBe'].keys()) if activity.get('indexesToBe') else []
+            blended_bands = activity['bands'] + activity['internal_bands'] + indexes_list
+
+            dirname_ql = activity['dirname'].replace(f'{identity_cube}/', f'{cube_name}/')
+            range_date = f'{activity["start"]}_{activity["end"]}'
+
+        for function in functions:
             # Generate quicklook
             qlfiles = []
             for band in qlbands:
                 qlfiles.append(prefix + activity['blended'][band][function + 'file'])
     
-            png_name = generateQLook(general_scene_id, qlfiles)
-            png_file_name = Path(png_name).name
-            if png_name is None:
+            png = generateQLook(general_scene_id, qlfiles)
+            if png is None:
                 raise Exception(f'publish - Error generateQLook for {general_scene_id}')
+            png_file_name = f'{general_scene_id}.png'
 
-            dirname_ql = activity['dirname'].replace(f'{identity_cube}/', f'{cube_name}/')
-            range_date = f'{activity["start"]}_{activity["end"]}'
-            s3_pngname = os.path.join(dirname_ql, range_date, png_file_name)
-            services.upload_file_S3(png_name, s3_pngname, {'ACL': 'public-read'}, bucket_name=bucket_name)
-            os.remove(png_name)
+            s3_pngname = f'{dirname_ql}{range_date}/{png_file_name}'
+            # The quicklook is uploaded while the band assets are described
+            quicklook_upload = uploader.submit(upload_quicklook, png, s3_pngname)
 
             quicklook_url = f'{bucket_name}/{s3_pngname}'
 
             # register items in DB
-            with db.session.begin_nested():
-                item = Item.query().filter(
-                    Item.name == general_scene_id,
-                    Item.collection_id == cube.id).first()
-                if not item:
-                    tile = Tile.query().filter(
-                        Tile.name == activity['tileid'],
-                        Tile.grid_ref_sys_id == cube.grid_ref_sys_id
-                    ).first()
-                    
-                    item = Item(
-                        name=general_scene_id,
-                        collection_id=cube.id,
-                        tile_id=tile.id,
-                        start_date=activity['start'],
-                        end_date=activity['end'],
-                        cloud_cover=float(activity['cloudratio']),
-                        srid=srid,
-                        application_id=APPLICATION_ID
-                    )
+            if not item:
+                item = Item(
+                    name=general_scene_id,
+                    collection_id=cube.id,
+                    tile_id=tile.id,
+                    start_date=activity['start'],
+                    end_date=activity['end'],
+                    cloud_cover=float(activity['cloudratio']),
+                    srid=srid,
+                    application_id=APPLICATION_ID
+                )
 
-                thumbnail, _, _ = create_asset_definition(
-                    services, bucket_name, str(s3_pngname), 'image/png', ['thumbnail'], quicklook_url)
-                assets = dict(thumbnail=thumbnail)
+            # add 'assets'
+            band_paths = dict()
+            for band in blended_bands:
+                if not activity['blended'][band].get('{}file'.format(function)):
+                    continue
 
-                # add 'assets'
-                bands_by_cube = Band.query().filter(
-                    Band.collection_id == cube.id
-                ).all()
+                band_model = bands_by_cube.get(band)
+                if not band_model:
+                    raise Exception(f'band {band} not found!')
 
-                indexes_list = list(activity['indexesToBe'].keys()) if activity.get('indexesToBe') else []
-                for band in (activity['bands'] + activity['internal_bands'] + indexes_list):
-                    if not activity['blended'][band].get('{}file'.format(function)):
-                        continue
+                band_paths[band_model.name] = activity["blended"][band][function + "file"]
 
-                    band_model = next(filter(lambda b: str(b.name) == band, bands_by_cube), None)
-                    if not band_model:
-                        raise Exception(f'band {band} not found!')
+            assets = describe_band_assets(item, band_paths)
 
-                    relative_path = activity["blended"][band][function + "file"]        
-                    full_path = f'{bucket_name}/{relative_path}'
-                    assets[band_model.name], item.geom, item.min_convex_hull = create_asset_definition(
-                        services, bucket_name,
-                        relative_path, COG_MIME_TYPE, ['data'],
-                        full_path, is_raster=True
-                    )
+            quicklook_upload.result()
+            thumbnail, _, _ = create_asset_definition(
+                services, bucket_name, str(s3_pngname), 'image/png', ['thumbnail'], quicklook_url)
 
-                item.assets = assets
-                item.updated = datetime.now()
-                db.session.add(item)
-            db.session.commit()
+            item.assets = dict(thumbnail=thumbnail, **assets)
+            item.updated = now
+            published_items.append(item)
 
         ## for all ARD scenes (IDENTITY)
         if empty_file:
@@ -1796,91 +1985,111 @@ def publish(self, activity):
                     file_to_remove = f"{activity['dirname']}{date_ref}/{files[band_key]}"
                     _ = services.delete_file_S3(bucket_name=bucket_name, key=file_to_remove)
             
-        else:
-            for date_ref in activity['scenes']:
-                scene = activity['scenes'][date_ref]
+        elif activity['scenes']:
+            cube_name = activity['irregular_datacube']
+            cube = Collection.query().filter(
+                Collection.name == cube_name,
+                Collection.version == collection_version
+            ).first()
+            if not cube:
+                raise Exception(f'cube {cube_name} - {activity["version"]} not found!')
+
+            bands_by_cube = {
+                str(band_model.name): band_model
+                for band_model in Band.query().filter(Band.collection_id == cube.id).all()
+            }
+
+            tile = Tile.query().filter(
+                Tile.name == activity['tileid'],
+                Tile.grid_ref_sys_id == cube.grid_ref_sys_id
+            ).first()
 
-                cube_name = activity['irregular_datacube']
-                cube = Collection.query().filter(
-                    Collection.name == cube_name,
-                    Collection.version == int(activity['version'][-3:])
-                ).first()
-                if not cube:
-                    raise Exception(f'cube {cube_name} - {activity["version"]} not found!')
+            # Acquisition date (YYYY-MM-DD) and item name of each scene
+            scene_dates = {date_ref: str(scene['date'])[0:10] for date_ref, scene in activity['scenes'].items()}
+            scene_id_prefix = f"{cube_name}_{activity['version']}_{activity['tileid']}_"
+            scene_ids = {date_ref: scene_id_prefix + date for date_ref, date in scene_dates.items()}
+
+            # Fetch the items already registered for the scenes in a single query
+            items = {
+                item.name: item
+                for item in Item.query().filter(
+                    Item.name.in_(list(scene_ids.values())),
+                    Item.collection_id == cube.id
+                ).all()
+            }
+
+            indexes_list = [] if indexes_only_regular_cube or not activity.get('indexesToBe') else list(activity['indexesToBe'].keys())
+            scene_bands = activity['bands'] + indexes_list
 
-                general_scene_id = '{}_{}_{}_{}'.format(
-                    cube_name, activity['version'], activity['tileid'], str(scene['date'])[0:10])
+            def generate_scene_quicklook(date_ref):
+                scene = activity['scenes'][date_ref]
 
-                # Generate quicklook
                 qlfiles = []
                 for band in qlbands:
-                    filename = os.path.join(prefix + activity['dirname'], str(scene['date'])[0:10], scene['ARDfiles'][band])
+                    filename = f"{prefix}{activity['dirname']}{scene_dates[date_ref]}/{scene['ARDfiles'][band]}"
                     qlfiles.append(filename)
 
-                png_name = generateQLook(general_scene_id, qlfiles)
-                png_file_name = Path(png_name).name
-                if png_name is None:
+                return generateQLook(scene_ids[date_ref], qlfiles)
+
+            # Generate quicklook, the next scenes are generated while the current one is registered
+            quicklooks = ordered_map(generator, generate_scene_quicklook, activity['scenes'],
+                                     max_pending=QUICKLOOK_PREFETCH)
+
+            for date_ref, png in zip(activity['scenes'], quicklooks):
+                scene = activity['scenes'][date_ref]
+
+                general_scene_id = scene_ids[date_ref]
+
+                if png is None:
                     raise Exception(f'publish - Error generateQLook for {general_scene_id}')
+                png_file_name = f'{general_scene_id}.png'
 
-                date = str(scene['date'])[0:10]
-                s3_pngname = os.path.join(activity['dirname'], date, png_file_name)
-                services.upload_file_S3(png_name, s3_pngname, {'ACL': 'public-read'}, bucket_name=bucket_name)
-                os.remove(png_name)
+                date = scene_dates[date_ref]
+                s3_pngname = f"{activity['dirname']}{date}/{png_file_name}"
+                # The quicklook is uploaded while the band assets are described
+                quicklook_upload = uploader.submit(upload_quicklook, png, s3_pngname)
 
                 quicklook_url = f'{bucket_name}/{s3_pngname}'
 
                 # register items in DB
-                with db.session.begin_nested():
-                    item = Item.query().filter(
-                        Item.name == general_scene_id,
-                        Item.collection_id == cube.id).first()
-                    if not item:
-                        tile = Tile.query().filter(
-                            Tile.name == activity['tileid'],
-                            Tile.grid_ref_sys_id == cube.grid_ref_sys_id
-                        ).first()
-                        
-                        item = Item(
-                            name=general_scene_id,
-                            collection_id=cube.id,
-                            tile_id=tile.id,
-                            start_date=scene['date'],
-                            end_date=scene['date'],
-                            cloud_cover=float(scene['cloudratio']),
-                            srid=srid,
-                            application_id=APPLICATION_ID
-                        )
-
-                    thumbnail, _, _ = create_asset_definition(
-                        services, bucket_name, str(s3_pngname), 'image/png', ['thumbnail'], quicklook_url)
-                    assets = dict(thumbnail=thumbnail)
-
-                    # insert 'assets'
-                    bands_by_cube = Band.query().filter(
-                        Band.collection_id == cube.id
-                    ).all()
-                    
-                    indexes_list = [] if indexes_only_regular_cube or not activity.get('indexesToBe') else list(activity['indexesToBe'].keys())
-                    for band in (activity['bands'] + indexes_list):
-                        if band not in scene['ARDfiles']:
-                            raise Exception(f'publish - problem - band {band} not in scene[files]')
-
-                        band_model = next(filter(lambda b: str(b.name) == band, bands_by_cube), None)
-                        if not band_model:
-                            raise Exception(f'band {band} not found!')
-                        
-                        relative_path = os.path.join(activity['dirname'], str(scene['date'])[0:10], scene['ARDfiles'][band])
-                        full_path = f'{bucket_name}/{relative_path}'
-                        assets[band_model.name], item.geom, item.min_convex_hull = create_asset_definition(
-                            services, bucket_name,
-                            relative_path, COG_MIME_TYPE, ['data'],
-                            full_path, is_raster=True
-                        )
-                    
-                    item.assets = assets
-                    item.updated = datetime.now()
-                    db.session.add(item)
-                db.session.commit()
+                item = items.get(general_scene_id)
+                if not item:
+                    item = Item(
+                        name=general_scene_id,
+                        collection_id=cube.id,
+                        tile_id=tile.id,
+                        start_date=scene['date'],
+                        end_date=scene['date'],
+                        cloud_cover=float(scene['cloudratio']),
+                        srid=srid,
+                        application_id=APPLICATION_ID
+                    )
+
+                # insert 'assets'
+                band_paths = dict()
+                for band in scene_bands:
+                    if band not in scene['ARDfiles']:
+                        raise Exception(f'publish - problem - band {band} not in scene[files]')
+
+                    band_model = bands_by_cube.get(band)
+                    if not band_model:
+                        raise Exception(f'band {band} not found!')
+
+                    band_paths[band_model.name] = f"{activity['dirname']}{date}/{scene['ARDfiles'][band]}"
+
+                assets = describe_band_assets(item, band_paths)
+
+                quicklook_upload.result()
+                thumbnail, _, _ = create_asset_definition(
+                    services, bucket_name, str(s3_pngname), 'image/png', ['thumbnail'], quicklook_url)
+
+                item.assets = dict(thumbnail=thumbnail, **assets)
+                item.updated = now
+                published_items.append(item)
+
+        # Register all the items of the activity at once
+        db.session.add_all(published_items)
+        db.session.commit()
 
         # Update status and end time in DynamoDB
         activity['myend'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -1888,6 +2097,8 @@ def publish(self, activity):
         services.put_item_kinesis(activity)
 
     except Exception as e:
+        db.session.rollback()
+
         activity['mystatus'] = 'ERROR'
         activity['errors'] = dict(
             step='publish',
@@ -1896,4 +2107,9 @@ def publish(self, activity):
         activity['myend'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         services.put_item_kinesis(activity)
 
-        logger.error(str(e), exc_info=True)
\ No newline at end of file
+        logger.error(str(e), exc_info=True)
+
+    finally:
+        describer.shutdown()
+        generator.shutdown()
+        uploader.shutdown()
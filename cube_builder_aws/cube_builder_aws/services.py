@@ -8,31 +8,108 @@
 
 import json
 import re
+import time
+from functools import lru_cache
 from urllib.parse import urlparse
 
 import boto3
 from boto3.dynamodb.conditions import Attr, Key
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.errorfactory import ClientError
 from stac import STAC
 
 from .config import (AWS_KEY_ID, AWS_SECRET_KEY, KINESIS_NAME,
                      LAMBDA_FUNCTION_NAME, QUEUE_NAME, TABLE_NAME)
 
+# Limits of AWS batch requests
+DYNAMO_MAX_BATCH_GET_KEYS = 100
+KINESIS_MAX_BATCH_RECORDS = 500
+KINESIS_MAX_BATCH_BYTES = 5 * 1024 * 1024
+KINESIS_MAX_RECORD_BYTES = 1024 * 1024
+SQS_MAX_BATCH_MESSAGES = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+
+# Retries of the items rejected (throttled) in batch requests, waiting
+# BATCH_RETRY_DELAY * 2 ** attempt seconds before each one
+BATCH_MAX_RETRIES = 6
+BATCH_RETRY_DELAY = 0.1
+
+KINESIS_PARTITION_KEY = 'dsKinesis'
+
+# Connections kept by the S3 client, shared by the threads uploading and reading assets
+S3_MAX_POOL_CONNECTIONS = 32
+
+# Multipart settings of the S3 uploads, the parts of a file are sent concurrently
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
+
+def get_transfer_config(max_concurrency=None):
+    """Get the S3 transfer config, with the given number of concurrent parts when set."""
+    if max_concurrency is None:
+        return S3_TRANSFER_CONFIG
+
+    return TransferConfig(
+        multipart_threshold=S3_TRANSFER_CONFIG.multipart_threshold,
+        multipart_chunksize=S3_TRANSFER_CONFIG.multipart_chunksize,
+        max_concurrency=max_concurrency,
+        use_threads=True
+    )
+
+
+@lru_cache(maxsize=None)
+def get_session():
+    """Get the boto3 session shared by the services of the process."""
+    return boto3.Session(
+        aws_access_key_id=AWS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_KEY)
+
+
+@lru_cache(maxsize=None)
+def get_client(service_name):
+    """Get the client of an AWS service, created once by process to reuse its connections.
+
+    The clients are thread safe, so the S3 client is shared by the threads of a step.
+    """
+    if service_name == 's3':
+        config = Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        retries=dict(max_attempts=10, mode='standard'))
+        return get_session().client('s3', config=config)
+
+    return get_session().client(service_name)
+
+
+def wait_batch_retry(attempt):
+    """Wait before retrying the rejected items of a batch request, with exponential backoff."""
+    time.sleep(BATCH_RETRY_DELAY * 2 ** attempt)
+
+
+def dumps_activity(activity):
+    """Serialize an activity to JSON in the compact form sent to Kinesis and SQS."""
+    return json.dumps(activity, separators=(',', ':'))
+
+
+def dumps_kinesis_record(activity):
+    """Serialize an activity with the attributes routing it from Kinesis to DynamoDB."""
+    return dumps_activity(dict(activity, channel='kinesis', db='dynamodb'))
+
 
 class CubeServices:
     
     def __init__(self, bucket=None, stac_list=[]):
         # session = boto3.Session(profile_name='beto')
-        self.session = session = boto3.Session(
-            aws_access_key_id=AWS_KEY_ID, 
-            aws_secret_access_key=AWS_SECRET_KEY)
+        self.session = session = get_session()
 
         # ---------------------------
         # AWS infrastructure
-        self.S3client = session.client('s3')
-        self.SQSclient = session.client('sqs')
-        self.LAMBDAclient = session.client('lambda')
-        self.Kinesisclient = session.client('kinesis')
+        self.S3client = get_client('s3')
+        self.SQSclient = get_client('sqs')
+        self.LAMBDAclient = get_client('lambda')
+        self.Kinesisclient = get_client('kinesis')
         self.dynamoDBResource = session.resource('dynamodb')
 
         self.bucket_name = bucket
@@ -81,6 +158,41 @@ class CubeServices:
             Key=query
         )
 
+    def get_activity_items(self, keys):
+        """Retrieve the activities of the given keys using BatchGetItem (up to 100 keys per request).
+
+        The unprocessed keys are requested again with exponential backoff, up to ``BATCH_MAX_RETRIES`` times.
+
+        Returns:
+            dict: Activities found, indexed by ``(id, sk)``.
+        """
+        table_name = self.tables['act'].name
+
+        unique_keys = list({(key['id'], key['sk']): key for key in keys}.values())
+
+        items = dict()
+        for i in range(0, len(unique_keys), DYNAMO_MAX_BATCH_GET_KEYS):
+            request_items = {table_name: dict(Keys=unique_keys[i:i + DYNAMO_MAX_BATCH_GET_KEYS])}
+
+            for attempt in range(BATCH_MAX_RETRIES + 1):
+                if attempt:
+                    wait_batch_retry(attempt - 1)
+
+                response = self.dynamoDBResource.batch_get_item(RequestItems=request_items)
+
+                for item in response['Responses'].get(table_name, []):
+                    items[(item['id'], item['sk'])] = item
+
+                # Keys not processed, usually throttled by the table throughput
+                request_items = response.get('UnprocessedKeys')
+                if not request_items:
+                    break
+            else:
+                raise Exception(f'DynamoDB left {len(request_items[table_name]["Keys"])} keys unprocessed '
+                                f'after {BATCH_MAX_RETRIES} retries')
+
+        return items
+
     def get_process_by_id(self, process_id):
         return self.tables['process'].query(
             KeyConditionExpression=Key('id').eq(process_id)
@@ -138,8 +250,19 @@ class CubeServices:
         return self.get_all_items(expression)
 
     def put_activity(self, activity):
+        merge_attributes = dict()
+        if activity['action'] == 'merge':
+            # Attributes used by the blend, to avoid decoding the activity JSON
+            merge_attributes = {
+                'scene_date': activity['date'],
+                'satellite': activity['satellite'],
+                'platform': activity.get('platform'),
+                'ard_file': activity['ARDfile'],
+            }
+
         self.tables['act'].put_item(
             Item={
+                **merge_attributes,
                 'id': activity['dynamoKey'],
                 'sk': activity['sk'],
 
@@ -272,29 +395,105 @@ class CubeServices:
 
         return True
 
-    def send_to_sqs(self, activity):
-        action = activity['action']
-        self.SQSclient.send_message(QueueUrl=self.queues[action], MessageBody=json.dumps(activity))
+    def _send_messages_to_sqs(self, messages):
+        """Send the (action, message) pairs to SQS using SendMessageBatch.
+
+        The messages are grouped by queue (action) in batches of up to 10 messages
+        and 256 KiB, which are the limits of SQS batch requests.
+        """
+        messages_by_queue = dict()
+        for action, message in messages:
+            messages_by_queue.setdefault(self.queues[action], []).append(message)
+
+        for queue_url, messages in messages_by_queue.items():
+            batch = []
+            batch_size = 0
+            for message in messages:
+                message_size = len(message.encode('utf-8'))
+                if batch and (len(batch) == SQS_MAX_BATCH_MESSAGES or batch_size + message_size > SQS_MAX_BATCH_BYTES):
+                    self._send_message_batch(queue_url, batch)
+                    batch = []
+                    batch_size = 0
+
+                batch.append(message)
+                batch_size += message_size
+
+            if batch:
+                self._send_message_batch(queue_url, batch)
+
+    def _send_message_batch(self, queue_url, messages):
+        entries = [dict(Id=str(i), MessageBody=message) for i, message in enumerate(messages)]
+
+        response = self.SQSclient.send_message_batch(QueueUrl=queue_url, Entries=entries)
+
+        # Retry one by one the messages rejected in batch request
+        for failed in response.get('Failed', []):
+            self.SQSclient.send_message(QueueUrl=queue_url, MessageBody=messages[int(failed['Id'])])
 
     
     ## ----------------------
     # Kinesis
     def put_item_kinesis(self, activity):
-        activity['channel'] = 'kinesis'
-        activity['db'] = 'dynamodb'
-        status = self.sendToKinesis(activity)
-        del activity['channel']
-        del activity['db']
-        return status
-
-    def sendToKinesis(self, activity):
         self.Kinesisclient.put_record(
-			StreamName=KINESIS_NAME,
-			Data=json.dumps(activity),
-    		PartitionKey='dsKinesis'
-		)
+            StreamName=KINESIS_NAME,
+            Data=dumps_kinesis_record(activity),
+            PartitionKey=KINESIS_PARTITION_KEY
+        )
         return True
 
+    def _put_records_kinesis(self, payloads):
+        """Send the payloads to Kinesis using PutRecords.
+
+        The records are sent in batches of up to 500 records and 5 MiB, which are the
+        limits of Kinesis batch requests. A record is limited to 1 MiB.
+        """
+        partition_key_size = len(KINESIS_PARTITION_KEY.encode('utf-8'))
+
+        batch = []
+        batch_size = 0
+        for payload in payloads:
+            record_size = len(payload.encode('utf-8')) + partition_key_size
+            if record_size > KINESIS_MAX_RECORD_BYTES:
+                raise Exception(f'Kinesis record of {record_size} bytes exceeds the '
+                                f'limit of {KINESIS_MAX_RECORD_BYTES} bytes')
+
+            if batch and (len(batch) == KINESIS_MAX_BATCH_RECORDS or
+                          batch_size + record_size > KINESIS_MAX_BATCH_BYTES):
+                self._put_record_batch(batch)
+                batch = []
+                batch_size = 0
+
+            batch.append(dict(Data=payload, PartitionKey=KINESIS_PARTITION_KEY))
+            batch_size += record_size
+
+        if batch:
+            self._put_record_batch(batch)
+
+    def _put_record_batch(self, records):
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            if attempt:
+                wait_batch_retry(attempt - 1)
+
+            response = self.Kinesisclient.put_records(StreamName=KINESIS_NAME, Records=records)
+            if not response.get('FailedRecordCount'):
+                return
+
+            # Retry in batch the records rejected, usually throttled by the shard throughput
+            failed = [(record, result) for record, result in zip(records, response['Records'])
+                      if 'ErrorCode' in result]
+            records = [record for record, _ in failed]
+
+        raise Exception(f'Kinesis rejected {len(records)} records after {BATCH_MAX_RETRIES} retries: '
+                        f'{failed[0][1]["ErrorCode"]}')
+
+    def dispatch_activities(self, activities):
+        """Register the activities in Kinesis and send them to their SQS queues.
+
+        Both requests are batched, the Kinesis records also carry the channel attributes.
+        """
+        self._put_records_kinesis([dumps_kinesis_record(activity) for activity in activities])
+        self._send_messages_to_sqs([(activity['action'], dumps_activity(activity)) for activity in activities])
+
 
     ## ----------------------
     # S3
@@ -329,6 +528,18 @@ class CubeServices:
         except ClientError:
             return False
 
+    def list_s3_keys(self, prefix, bucket_name=None):
+        """List all the object keys which starts with the given prefix."""
+        if not bucket_name:
+            bucket_name = self.bucket_name
+
+        keys = set()
+        paginator = self.S3client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            keys.update(obj['Key'] for obj in page.get('Contents', []))
+
+        return keys
+
     def get_object(self, key, bucket_name=None):
         return self.S3client.get_object(Bucket=bucket_name, Key=key)
 
@@ -350,24 +561,26 @@ class CubeServices:
             Body=(bytes(json.dumps(activity).encode('UTF-8')))
         )
 
-    def upload_file_S3(self, memfile, key, args, bucket_name=None):
+    def upload_file_S3(self, memfile, key, args, bucket_name=None, max_concurrency=None):
         if not bucket_name:
             bucket_name = self.bucket_name
         return self.S3client.upload_file(
             memfile, 
             Bucket=bucket_name,
             Key=key,
-            ExtraArgs=args
+            ExtraArgs=args,
+            Config=get_transfer_config(max_concurrency)
         )
 
-    def upload_fileobj_S3(self, memfile, key, args, bucket_name=None):
+    def upload_fileobj_S3(self, memfile, key, args, bucket_name=None, max_concurrency=None):
         if not bucket_name:
             bucket_name = self.bucket_name
         return self.S3client.upload_fileobj(
             memfile, 
             Bucket=bucket_name,
             Key=key,
-            ExtraArgs=args
+            ExtraArgs=args,
+            Config=get_transfer_config(max_concurrency)
         )
 
     def list_repositories(self):
@@ -9,12 +9,24 @@
 """Simple abstraction of Python Interpreter."""
 
 import ast
+from functools import lru_cache
 from typing import Any, Dict
 
 # Type for Python Execution Code Context.
 ExecutionContext = Dict[str, Any]
 
 
+@lru_cache(maxsize=128)
+def compile_expression(expression: str):
+    """Parse and compile a string expression, caching the code object by expression.
+
+    The same band expression is executed for every block of a raster, so it is only compiled once.
+    """
+    ast_expression = ast.parse(expression)
+
+    return compile(ast_expression, '<ast>', 'exec')
+
+
 def execute(expression: str, context: dict) -> ExecutionContext:
     """Evaluate a string expression as Python object and execute in Python Interpreter.
 
@@ -41,9 +53,7 @@ def execute(expression: str, context: dict) -> ExecutionContext:
     Returns:
         Map of context values loaded in memory.
     """
-    ast_expression = ast.parse(expression)
-
-    compiled_expression = compile(ast_expression, '<ast>', 'exec')
+    compiled_expression = compile_expression(expression)
 
     exec(compiled_expression, context)
 
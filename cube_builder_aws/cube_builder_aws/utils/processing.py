@@ -9,8 +9,13 @@
 import datetime
 import hashlib
 import os
+import queue
 import shutil
-from collections import Iterable
+import threading
+from collections import Iterable, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
 from pathlib import Path
 from typing import List, NamedTuple, Tuple, Union
 
@@ -23,27 +28,34 @@ from bdc_catalog.models import db
 from bdc_catalog.utils import \
     multihash_checksum_sha256 as _multihash_checksum_sha256
 from flask import abort
+from geoalchemy2 import func
 from geoalchemy2.shape import from_shape
 from numpngw import write_png
 from rasterio.io import MemoryFile
+from rasterio.windows import Window
 from rio_cogeo.cogeo import cog_translate
 from rio_cogeo.profiles import cog_profiles
 from sensor_harm.landsat import landsat_harmonize
 
+from ..constants import (GEOM_WGS84_COLUMN, GEOM_WGS84_MIN_SERVER_VERSION,
+                         READ_BLOCK_LINES)
 from ..logger import logger
 from .interpreter import execute
 
 
 def get_date(str_date):
-    return datetime.datetime.strptime(str_date, '%Y-%m-%d %H:%M:%S')
+    # fromisoformat parses the '%Y-%m-%d %H:%M:%S' dates without the strptime overhead
+    return datetime.datetime.fromisoformat(str_date)
 
 
 #############################
-def encode_key(activity, keylist):
-    dynamoKey = ''
-    for key in keylist:
-        dynamoKey += activity[key]
-    return dynamoKey
+def encode_key(activity, keylist, base=''):
+    """Build a DynamoDB key joining the activity values of keylist.
+
+    The optional base is a previously encoded key fragment used as prefix,
+    so the invariant part of a key is only built once.
+    """
+    return base + ''.join(activity[key] for key in keylist)
 
 
 ############################
@@ -277,23 +289,29 @@ def generateQLook(generalSceneId, qlfiles):
 
         numlin = 768
         numcol = int(float(profile['width'])/float(profile['height'])*numlin)
-        image = numpy.ones((numlin,numcol,len(qlfiles),), dtype=numpy.uint8)
-        pngname = '/tmp/{}.png'.format(generalSceneId)
+        image = numpy.zeros((numlin,numcol,len(qlfiles),), dtype=numpy.uint8)
 
-        nb = 0
-        for file in qlfiles:
+        def read_quicklook_band(file):
+            # Decimated reads come from the COG overviews
             with rasterio.open(file) as src:
-                raster = src.read(1, out_shape=(numlin, numcol))
+                return src.read(1, out_shape=(numlin, numcol))
+
+        # Read the bands concurrently, rasterio releases the GIL while reading
+        with ThreadPoolExecutor(max_workers=len(qlfiles)) as executor:
+            for nb, raster in enumerate(executor.map(read_quicklook_band, qlfiles)):
                 # Rescale to 0-255 values
                 nodata = raster <= 0
                 if raster.min() != 0 or raster.max() != 0:
                     raster = raster.astype(numpy.float32)/10000.*255.
                     raster[raster>255] = 255
-                image[:,:,nb] = raster.astype(numpy.uint8) * numpy.invert(nodata)
-                nb += 1
-
-        write_png(pngname, image, transparent=(0, 0, 0))
-        return pngname
+                # Copy only valid pixels, nodata remains zero
+                numpy.copyto(image[:,:,nb], raster, casting='unsafe', where=numpy.invert(nodata))
+
+        # The PNG is kept in memory to be uploaded without a local file
+        png = BytesIO()
+        write_png(png, image, transparent=(0, 0, 0))
+        png.seek(0)
+        return png
         
     except Exception as e:
         logger.error(str(e), exc_info=True)
@@ -378,6 +396,47 @@ def get_or_create_model(model_class, defaults=None, **restrictions):
 
     return instance, True
 
+
+def create_geom_wgs84_column(geom_table):
+    """Add a stored column ``geom_4326`` with the tile geometry reprojected to EPSG:4326.
+
+    The column is generated by PostgreSQL from ``geom``, so the grid tiles are
+    reprojected only once instead of calling ``ST_Transform`` on every request.
+
+    Note:
+        Generated columns (``GENERATED ALWAYS ... STORED``) require PostgreSQL 12+. On older
+        servers the column is not created and ``get_geom_wgs84`` keeps using ``ST_Transform``.
+        Adding a stored column rewrites the grid table and holds an ``ACCESS EXCLUSIVE``
+        lock on it while running, so run it when the grid is not being queried.
+
+    Args:
+        geom_table (sqlalchemy.Table) - Grid geometry table
+    Returns:
+        bool: Whether the column exists in the grid table.
+    """
+    server_version = int(db.session.execute('SHOW server_version_num').scalar())
+    if server_version < GEOM_WGS84_MIN_SERVER_VERSION:
+        logger.warning(f'PostgreSQL {server_version} does not support generated columns, '
+                       f'{geom_table.fullname} will be reprojected by query.')
+        return False
+
+    db.session.execute(
+        f'ALTER TABLE {geom_table.fullname} ADD COLUMN IF NOT EXISTS {GEOM_WGS84_COLUMN} geometry(Geometry, 4326) '
+        f'GENERATED ALWAYS AS (ST_Transform(geom, 4326)) STORED'
+    )
+    return True
+
+
+def get_geom_wgs84(geom_table):
+    """Retrieve the grid tile geometry in EPSG:4326.
+
+    Uses the precomputed ``geom_4326`` column when available, otherwise falls back to ``ST_Transform``.
+    """
+    if GEOM_WGS84_COLUMN in geom_table.c:
+        return geom_table.c[GEOM_WGS84_COLUMN]
+    return func.ST_Transform(geom_table.c.geom, 4326)
+
+
 def get_cube_name(cube, function=None):
     if not function or function.upper() == 'IDT':
         return '_'.join(cube.split('_')[:-1])
@@ -396,6 +455,209 @@ def generate_hash_md5(word):
     return result.hexdigest()
 
 
+############################
+def get_block_windows(width, height, block_size=2048):
+    """Split a raster of the given dimension into square windows of ``block_size`` pixels.
+
+    The windows on the right/bottom edges are cropped to fit the raster.
+    """
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+
+
+def get_read_windows(dataset, block_lines=512):
+    """List the windows to read a dataset block by block.
+
+    Tiled datasets are read by their own blocks. Striped datasets have one-line blocks,
+    so their strips are grouped into windows of ``block_lines`` lines over the whole width.
+    """
+    if dataset.profile.get('tiled', False):
+        return [window for _, window in dataset.block_windows()]
+
+    return [
+        Window(0, row_off, dataset.width, min(block_lines, dataset.height - row_off))
+        for row_off in range(0, dataset.height, block_lines)
+    ]
+
+
+def build_lookup_table(values, size=65536):
+    """Build a boolean lookup table telling which integers of ``range(size)`` are in values.
+
+    For unsigned integer data, ``table[data]`` is equivalent to ``numpy.isin(data, values)``
+    but performs a single gather by pixel.
+    """
+    table = numpy.zeros(size, dtype=numpy.bool_)
+
+    values = numpy.asarray(values, dtype=numpy.int64)
+    table[values[(values >= 0) & (values < size)]] = True
+
+    return table
+
+
+def stack_median(stack, count):
+    """Compute the median of the valid values along the first axis of a stack.
+
+    The stack is sorted in place. The invalid samples must be filled with the maximum value
+    of the stack data type, so they are sorted after the valid ones, as ``numpy.ma.median`` does.
+
+    Args:
+        stack (numpy.ndarray) - Stack of observations (time, lines, columns)
+        count (numpy.ndarray) - Number of valid observations by pixel
+    Returns:
+        The median by pixel as float. Pixels without valid observation are undefined.
+    """
+    stack.sort(axis=0)
+
+    count = count.astype(numpy.intp)
+    lower = numpy.take_along_axis(stack, (numpy.maximum(count - 1, 0) // 2)[numpy.newaxis], axis=0)[0]
+    upper = numpy.take_along_axis(stack, (count // 2)[numpy.newaxis], axis=0)[0]
+
+    return (lower.astype(numpy.float64) + upper) / 2
+
+
+def prefetch_window_reads(readers, windows, max_workers):
+    """Read the blocks of the scene datasets for each window, one window ahead of the consumer.
+
+    Args:
+        readers (List[List[callable]]) - For each scene, the read functions of its datasets,
+            called as ``read(window=window)``. Each read is a separate task, so the datasets
+            of a scene are also read concurrently.
+        windows (List[Window]) - Windows to read
+        max_workers (int) - Number of threads
+    Yields:
+        For each window, the list with the tuple of blocks of each scene.
+
+    A dataset handle is not thread safe, so the reads of the next window are only
+    scheduled when all the reads of the current window are finished.
+
+    When the generator is closed or a read fails, the reads not started yet are cancelled.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit(window):
+            return [[executor.submit(read, window=window) for read in scene_readers] for scene_readers in readers]
+
+        futures = submit(windows[0]) if windows else []
+        try:
+            for index in range(len(windows)):
+                results = [tuple(future.result() for future in scene_futures) for scene_futures in futures]
+
+                if index + 1 < len(windows):
+                    futures = submit(windows[index + 1])
+
+                yield results
+        finally:
+            for scene_futures in futures:
+                for future in scene_futures:
+                    future.cancel()
+
+
+def get_tile_grid(xmin, ymax, dist_x, dist_y, resx, resy):
+    """Compute the raster grid of a tile for the given resolution.
+
+    Returns:
+        Tuple with the number of columns, the number of lines and the affine transform coefficients.
+    """
+    num_pixel_x = round(dist_x / resx)
+    num_pixel_y = round(dist_y / resy)
+
+    new_res_x = dist_x / num_pixel_x
+    new_res_y = dist_y / num_pixel_y
+
+    return num_pixel_x, num_pixel_y, (new_res_x, 0., xmin, 0., -new_res_y, ymax)
+
+
+def ordered_map(executor, fn, iterable, max_pending):
+    """Map ``fn`` over ``iterable`` in the executor, yielding the results in the iterable order.
+
+    At most ``max_pending`` calls are scheduled ahead of the consumer, which bounds the results held in memory.
+    """
+    pending = deque()
+    for value in iterable:
+        pending.append(executor.submit(fn, value))
+
+        if len(pending) > max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def ordered_stream_map(executor, fn, iterable, max_buffered):
+    """Run the generator function ``fn`` over ``iterable`` in the executor, streaming the items in the iterable order.
+
+    Each value is produced by a task which puts the items of ``fn(value)`` in its own queue of at most
+    ``max_buffered`` items, so the values are produced concurrently while the items held in memory stay bounded
+    by the number of executor workers.
+
+    Yields:
+        For each value, an iterator over the items of ``fn(value)``. It must be consumed entirely before the next one.
+
+    The generator must be closed (e.g. with ``contextlib.closing``) before the executor shutdown, which stops the
+    producers blocked on their queues when the consumer gives up. When a value fails, the other producers are stopped
+    and the ones not started are cancelled, then the consumer gets the error of the first failure.
+    """
+    stop = threading.Event()
+    errors = []
+    futures = []
+
+    def cancel():
+        stop.set()
+        for future in list(futures):
+            future.cancel()
+
+    def put(items, entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(value, items):
+        if stop.is_set():
+            return
+
+        produced = fn(value)
+        try:
+            for item in produced:
+                if not put(items, (True, item)):
+                    return
+            put(items, (False, None))
+        except Exception as e:
+            errors.append(e)
+            cancel()
+        finally:
+            produced.close()
+
+    def consume(items):
+        while True:
+            try:
+                has_item, item = items.get(timeout=0.1)
+            except queue.Empty:
+                # The producers were stopped by a failure, the remaining items will not come
+                if errors:
+                    raise errors[0]
+                continue
+
+            if not has_item:
+                return
+            yield item
+
+    try:
+        queues = []
+        for value in iterable:
+            items = queue.Queue(maxsize=max_buffered)
+            futures.append(executor.submit(produce, value, items))
+            queues.append(items)
+
+        for items in queues:
+            yield consume(items)
+    finally:
+        cancel()
+
+
 ############################
 def create_cog_in_s3(services, profile, path, raster, bucket_name, nodata=None, tags=None):
     with MemoryFile() as dst_file:
@@ -460,7 +722,6 @@ def create_index(services, index, bands_expressions, bands, bucket_name, index_f
     """
     prefix = services.get_s3_prefix(bucket_name)
 
-    map_data_set_context = dict()
     band_definition = bands_expressions[index]
     band_expression = band_definition['expression']['value']
     band_data_type = band_definition['data_type']
@@ -468,29 +729,32 @@ def create_index(services, index, bands_expressions, bands, bucket_name, index_f
     data_type_max_value = data_type_info.max
     data_type_min_value = data_type_info.min
 
-    profile = blocks = None
-
-    for _band, relative_path in bands.items():
-        absolute_path = os.path.join(prefix, str(relative_path))
-        map_data_set_context[_band] = AutoCloseDataSet(absolute_path)
+    # Open the band files concurrently
+    with ThreadPoolExecutor(max_workers=len(bands)) as executor:
+        data_sets = executor.map(lambda path: AutoCloseDataSet(os.path.join(prefix, str(path))), bands.values())
+        map_data_set_context = dict(zip(bands.keys(), data_sets))
 
-        if profile is None:
-            profile = map_data_set_context[_band].dataset.profile
-            blocks = map_data_set_context[_band].dataset.block_windows()
+    first_data_set = next(iter(map_data_set_context.values())).dataset
+    profile = first_data_set.profile
+    blocks = get_read_windows(first_data_set, block_lines=READ_BLOCK_LINES)
 
     profile['dtype'] = band_data_type
     raster = numpy.full((profile['height'], profile['width']), dtype=band_data_type, fill_value=profile['nodata'])
 
-    for _, window in blocks:
-        row_offset = window.row_off + window.height
-        col_offset = window.col_off + window.width
+    expr = f'{index} = {band_expression}'
 
-        machine_context = {
-            k: ds.dataset.read(1, masked=True, window=window).astype(numpy.float32)
-            for k, ds in map_data_set_context.items()
-        }
+    # Read the blocks straight as float32, without an extra copy to cast them.
+    # The bands are read concurrently, one window ahead of the expression evaluation
+    band_names = list(map_data_set_context.keys())
+    readers = [
+        [partial(map_data_set_context[_band].dataset.read, 1, masked=True, out_dtype=numpy.float32)]
+        for _band in band_names
+    ]
+    window_blocks = prefetch_window_reads(readers, blocks, max_workers=len(readers))
+
+    for window, band_blocks in zip(blocks, window_blocks):
+        machine_context = {_band: band_block for _band, (band_block,) in zip(band_names, band_blocks)}
 
-        expr = f'{index} = {band_expression}'
         result = execute(expr, context=machine_context)
         raster_block = result[index]
         raster_block[raster_block == numpy.ma.masked] = profile['nodata']
@@ -499,9 +763,9 @@ def create_index(services, index, bands_expressions, bands, bucket_name, index_f
         raster_block[raster_block < data_type_min_value] = data_type_min_value
         raster_block[raster_block > data_type_max_value] = data_type_max_value
 
-        raster[window.row_off: row_offset, window.col_off: col_offset] = raster_block
+        raster[window.toslices()] = raster_block
 
-    create_cog_in_s3(services, profile, index_file_path, raster.astype(numpy.int16), bucket_name)
+    create_cog_in_s3(services, profile, index_file_path, raster.astype(numpy.int16, copy=False), bucket_name)
 
 
 ############################
@@ -517,7 +781,7 @@ def multihash_checksum_sha256(services, bucket_name, entry) -> str:
 
 ############################
 def create_asset_definition(services, bucket_name: str, href: str, mime_type: str, role: List[str], absolute_path: str,
-                            created=None, is_raster=False):
+                            created=None, is_raster=False, compute_geom=True):
     """Create a valid asset definition for collections.
     TODO: Generate the asset for `Item` field with all bands
     Args:
@@ -527,6 +791,7 @@ def create_asset_definition(services, bucket_name: str, href: str, mime_type: st
         absolute_path - Absolute path to the asset. Required to generate check_sum
         created - Date time str of asset. When not set, use current timestamp.
         is_raster - Flag to identify raster. When set, `raster_size` and `chunk_size` will be set to the asset.
+        compute_geom - Flag to compute the raster footprint. When not set, no geometry is returned.
     """
     try:
         fmt = '%Y-%m-%dT%H:%M:%S'
@@ -560,9 +825,10 @@ def create_asset_definition(services, bucket_name: str, href: str, mime_type: st
                     y=data_set.shape[0],
                 )
 
-                _geom = shapely.geometry.mapping(shapely.geometry.box(*data_set.bounds))
-                geom_shape = shapely.geometry.shape(rasterio.warp.transform_geom(data_set.crs, 'EPSG:4326', _geom))
-                geom = from_shape(geom_shape, srid=4326)
+                if compute_geom:
+                    _geom = shapely.geometry.mapping(shapely.geometry.box(*data_set.bounds))
+                    geom_shape = shapely.geometry.shape(rasterio.warp.transform_geom(data_set.crs, 'EPSG:4326', _geom))
+                    geom = from_shape(geom_shape, srid=4326)
 
                 # data = data_set.read(1, masked=True, out_dtype=numpy.uint8)
                 # data[data == numpy.ma.masked] = 0
@@ -10,85 +10,104 @@
 Utility functions to parser scene_id.
 """
 import re
+from functools import lru_cache
 from typing import Any, Dict
 
+SENTINEL_2_PATTERN = re.compile(
+    r"^S"
+    r"(?P<sensor>\w{1})"
+    r"(?P<satellite>[AB]{1})"
+    r"_"
+    r"MSI(?P<processingLevel>L[0-2][ABC])"
+    r"_"
+    r"(?P<acquisitionYear>[0-9]{4})"
+    r"(?P<acquisitionMonth>[0-9]{2})"
+    r"(?P<acquisitionDay>[0-9]{2})"
+    r"T(?P<acquisitionHMS>[0-9]{6})"
+    r"_"
+    r"N(?P<baseline_number>[0-9]{4})"
+    r"_"
+    r"R(?P<relative_orbit>[0-9]{3})"
+    r"_T"
+    r"(?P<utm>[0-9]{2})"
+    r"(?P<lat>\w{1})"
+    r"(?P<sq>\w{2})"
+    r"_"
+    r"(?P<stopDateTime>[0-9]{8}T[0-9]{6})$",
+    re.IGNORECASE
+)
+
+LANDSAT_PATTERN = re.compile(
+    r"^L"
+    r"(?P<sensor>\w{1})"
+    r"(?P<satellite>\w{2})"
+    r"_"
+    r"(?P<processingCorrectionLevel>\w{4})"
+    r"_"
+    r"(?P<path>[0-9]{3})"
+    r"(?P<row>[0-9]{3})"
+    r"_"
+    r"(?P<acquisitionYear>[0-9]{4})"
+    r"(?P<acquisitionMonth>[0-9]{2})"
+    r"(?P<acquisitionDay>[0-9]{2})"
+    r"_"
+    r"(?P<processingYear>[0-9]{4})"
+    r"(?P<processingMonth>[0-9]{2})"
+    r"(?P<processingDay>[0-9]{2})"
+    r"_"
+    r"(?P<collectionNumber>\w{2})"
+    r"_"
+    r"(?P<collectionCategory>\w{2})$",
+    re.IGNORECASE
+)
+
+
+LANDSAT_INSTRUMENTS = {
+    '05': 'tm',
+    '07': 'etm',
+    '08': 'oli-tirs'
+}
 
-def sentinel_2(scene_id, args: Dict[str, Any] = dict()):
-    pattern = (
-        r"^S"
-        r"(?P<sensor>\w{1})"
-        r"(?P<satellite>[AB]{1})"
-        r"_"
-        r"MSI(?P<processingLevel>L[0-2][ABC])"
-        r"_"
-        r"(?P<acquisitionYear>[0-9]{4})"
-        r"(?P<acquisitionMonth>[0-9]{2})"
-        r"(?P<acquisitionDay>[0-9]{2})"
-        r"T(?P<acquisitionHMS>[0-9]{6})"
-        r"_"
-        r"N(?P<baseline_number>[0-9]{4})"
-        r"_"
-        r"R(?P<relative_orbit>[0-9]{3})"
-        r"_T"
-        r"(?P<utm>[0-9]{2})"
-        r"(?P<lat>\w{1})"
-        r"(?P<sq>\w{2})"
-        r"_"
-        r"(?P<stopDateTime>[0-9]{8}T[0-9]{6})$"
-    )
-    meta: Dict[str, Any] = re.match(pattern, scene_id, re.IGNORECASE).groupdict()
+
+@lru_cache(maxsize=4096)
+def _parse_sentinel_2(scene_id) -> Dict[str, Any]:
+    # Cached, the callers must copy the result before changing it
+    meta: Dict[str, Any] = SENTINEL_2_PATTERN.match(scene_id).groupdict()
 
     meta['acquisitionMonthInteger'] = int(meta['acquisitionMonth'])
     meta['acquisitionDayInteger'] = int(meta['acquisitionDay'])
 
-    return dict(scene_id=scene_id, **meta, **args)
+    return meta
+
+
+@lru_cache(maxsize=4096)
+def _parse_landsat(scene_id) -> Dict[str, Any]:
+    # Cached, the callers must copy the result before changing it
+    meta: Dict[str, Any] = LANDSAT_PATTERN.match(scene_id).groupdict()
+
+    meta['instrument'] = LANDSAT_INSTRUMENTS[meta['satellite']]
+
+    return meta
+
+
+def sentinel_2(scene_id, args: Dict[str, Any] = dict()):
+    return dict(scene_id=scene_id, **_parse_sentinel_2(scene_id), **args)
 
 
 def landsat(scene_id, args: Dict[str, Any] = dict()):
-    pattern = (
-        r"^L"
-        r"(?P<sensor>\w{1})"
-        r"(?P<satellite>\w{2})"
-        r"_"
-        r"(?P<processingCorrectionLevel>\w{4})"
-        r"_"
-        r"(?P<path>[0-9]{3})"
-        r"(?P<row>[0-9]{3})"
-        r"_"
-        r"(?P<acquisitionYear>[0-9]{4})"
-        r"(?P<acquisitionMonth>[0-9]{2})"
-        r"(?P<acquisitionDay>[0-9]{2})"
-        r"_"
-        r"(?P<processingYear>[0-9]{4})"
-        r"(?P<processingMonth>[0-9]{2})"
-        r"(?P<processingDay>[0-9]{2})"
-        r"_"
-        r"(?P<collectionNumber>\w{2})"
-        r"_"
-        r"(?P<collectionCategory>\w{2})$"
-    )
-    meta: Dict[str, Any] = re.match(pattern, scene_id, re.IGNORECASE).groupdict()
-
-    instruments = {
-        '05': 'tm',
-        '07': 'etm',
-        '08': 'oli-tirs'
-    }
-
-    meta['instrument'] = instruments[meta['satellite']]
-
-    return dict(scene_id=scene_id, **meta, **args)
+    return dict(scene_id=scene_id, **_parse_landsat(scene_id), **args)
+
+
+SCENE_PARSERS = dict(
+    sentinel_2=sentinel_2,
+    landsat=landsat
+)
 
 
 class SceneParser:
 
     def __init__(self, group):
-        parsers = dict(
-            sentinel_2=sentinel_2,
-            landsat=landsat
-        )
-
-        self.parser = parsers[group]
+        self.parser = SCENE_PARSERS[group]
 
     def parser_sceneid(self, scene_id, args):
         return self.parser(scene_id, args=args)
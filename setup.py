@@ -53,9 +53,9 @@ install_requires = [
     'boto3==1.14.49',
     'botocore==1.17.49',
     'marshmallow-sqlalchemy==0.25.0',
-    'numpy==1.18.0',
+    'numpy>=1.24,<1.25',
     'numpngw==0.0.8',
-    'rasterio>=1.1.2,<2',
+    'rasterio>=1.3,<2',
     'requests>=2.23.0',
     'rio-cogeo==1.1.10',
     'shapely==1.7.0',
@@ -0,0 +1,301 @@
+#
+# This file is part of Python Module for Cube Builder AWS.
+# Copyright (C) 2019-2021 INPE.
+#
+# Cube Builder AWS is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+#
+
+"""Define the unittests for the processing utilities."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import numpy
+import pytest
+
+from cube_builder_aws.cube_builder_aws.utils.processing import (
+    build_lookup_table, ordered_map, ordered_stream_map, prefetch_window_reads,
+    stack_median)
+
+
+class TestStackMedian:
+    nodata = -9999
+
+    def _build_stack(self, shape, seed=0):
+        random = numpy.random.default_rng(seed)
+
+        stack = random.integers(0, 10000, size=shape).astype(numpy.int16)
+        holes = random.random(shape) < 0.4
+
+        return stack, holes
+
+    def _assert_ma_median(self, stack, holes):
+        stack[holes] = self.nodata
+
+        expected = numpy.ma.median(numpy.ma.array(stack, mask=holes), axis=0)
+        count = numpy.count_nonzero(~holes, axis=0)
+
+        filled = numpy.where(holes, numpy.iinfo(stack.dtype).max, stack)
+        median = stack_median(filled, count)
+
+        valid = count > 0
+        numpy.testing.assert_allclose(median[valid], expected.data[valid])
+
+    def test_median_with_nodata_holes(self):
+        stack, holes = self._build_stack((7, 16, 16))
+        # Keep some pixels without any valid observation
+        holes[:, 0, :4] = True
+
+        self._assert_ma_median(stack, holes)
+
+    def test_median_even_and_odd_counts(self):
+        stack, holes = self._build_stack((6, 8, 8), seed=1)
+        holes[:] = False
+        # Pixels with 1 to 6 valid observations
+        for line in range(holes.shape[1]):
+            holes[:line % holes.shape[0], line, :] = True
+
+        self._assert_ma_median(stack, holes)
+
+    def test_median_without_holes(self):
+        stack, holes = self._build_stack((5, 4, 4), seed=2)
+        holes[:] = False
+
+        self._assert_ma_median(stack, holes)
+
+
+class TestLookupTable:
+    # Quality values of 8 and 16 bits, 255 is both not clear and saturated
+    clear_values = [0, 1, 322, 386]
+    not_clear_values = [2, 3, 4, 255, 324, 328, 352, 480, 992, 1346, 65535]
+    saturated_values = [255, 20480]
+    nodata = -9999
+
+    def _quality(self, dtype, seed=0):
+        random = numpy.random.default_rng(seed)
+        info = numpy.iinfo(dtype)
+
+        values = numpy.arange(info.min, info.max + 1, dtype=dtype)
+        # Every possible value, plus the classified ones repeated in a random order
+        known = numpy.array([v for v in self.clear_values + self.not_clear_values if v <= info.max], dtype=dtype)
+        data = numpy.concatenate([values, random.choice(known, size=4096)])
+
+        return random.permutation(data)
+
+    def test_isin_equivalence(self):
+        values = self.not_clear_values + [-1, 70000]
+        table = build_lookup_table(values)
+
+        for dtype in (numpy.uint8, numpy.uint16):
+            data = self._quality(dtype)
+            numpy.testing.assert_array_equal(table[data], numpy.isin(data, values))
+
+    def test_blend_mask(self):
+        masked_values = numpy.union1d(self.not_clear_values, self.saturated_values)
+        masked_table = build_lookup_table(masked_values)
+        not_clear_table = numpy.invert(build_lookup_table(self.clear_values))
+
+        random = numpy.random.default_rng(1)
+
+        for dtype in (numpy.uint8, numpy.uint16):
+            data = self._quality(dtype)
+            masked = numpy.ma.masked_equal(data, numpy.iinfo(dtype).max)
+            raster = numpy.where(random.random(data.shape) < 0.1, self.nodata, 1000).astype(numpy.int16)
+
+            expected = (masked.mask | numpy.isin(masked.data, masked_values) | (raster == self.nodata)) & \
+                numpy.invert(numpy.isin(masked.data, self.clear_values))
+            mask = (masked.mask | masked_table[masked.data] | (raster == self.nodata)) & \
+                not_clear_table[masked.data]
+
+            numpy.testing.assert_array_equal(mask, expected)
+
+
+class TestPrefetchWindowReads:
+    windows = [(slice(line, line + 2), slice(0, 8)) for line in range(0, 8, 2)]
+
+    @staticmethod
+    def _build_readers(datasets, events, delay=0):
+        lock = threading.Lock()
+
+        def reader(data):
+            def read(window):
+                index = TestPrefetchWindowReads.windows.index(window)
+                with lock:
+                    events.append(('start', index))
+                time.sleep(delay)
+                block = data[window].copy()
+                with lock:
+                    events.append(('end', index))
+                return block
+            return read
+
+        return [[reader(data) for data in scene] for scene in datasets]
+
+    def test_blocks_in_window_order(self):
+        datasets = [[numpy.arange(64).reshape(8, 8) * (scene + 1) + band for band in range(2)] for scene in range(3)]
+        readers = self._build_readers(datasets, [])
+
+        results = list(prefetch_window_reads(readers, self.windows, max_workers=4))
+
+        assert len(results) == len(self.windows)
+        for window, scenes in zip(self.windows, results):
+            assert len(scenes) == len(datasets)
+            for blocks, scene in zip(scenes, datasets):
+                assert len(blocks) == len(scene)
+                for block, data in zip(blocks, scene):
+                    numpy.testing.assert_array_equal(block, data[window])
+
+    def test_one_window_ahead(self):
+        events = []
+        datasets = [[numpy.zeros((8, 8))] * 2] * 3
+        readers = self._build_readers(datasets, events)
+        reads_by_window = 6
+
+        for index, _ in enumerate(prefetch_window_reads(readers, self.windows, max_workers=4)):
+            # The reads of the next window are scheduled, but not the ones after it
+            assert all(event_index <= index + 1 for _, event_index in events)
+
+        # A window is only read when all the reads of the previous one are finished
+        for position, (kind, index) in enumerate(events):
+            if kind == 'start' and index > 0:
+                finished = [event for event in events[:position] if event == ('end', index - 1)]
+                assert len(finished) == reads_by_window
+
+    def test_close_cancels_pending_reads(self):
+        events = []
+        datasets = [[numpy.zeros((8, 8))] * 2] * 3
+        readers = self._build_readers(datasets, events, delay=0.05)
+
+        with closing(prefetch_window_reads(readers, self.windows, max_workers=1)) as window_blocks:
+            next(window_blocks)
+
+        # Only the read running when the generator was closed is done for the next window
+        assert events.count(('start', 1)) < 6
+        assert all(index <= 1 for _, index in events)
+
+    def test_no_windows(self):
+        assert list(prefetch_window_reads([[lambda window: None]], [], max_workers=2)) == []
+
+
+class TestOrderedMap:
+    max_workers = 4
+
+    @staticmethod
+    def _delay(value):
+        # Later values finish first, so the completion order differs from the iterable order
+        time.sleep(0.001 * (10 - value % 10))
+
+    def test_results_in_order(self):
+        def square(value):
+            self._delay(value)
+            return value * value
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            assert list(ordered_map(executor, square, range(30), max_pending=3)) == [v * v for v in range(30)]
+
+    def test_pending_bound(self):
+        max_pending = 2
+        submitted = []
+
+        def values():
+            for value in range(20):
+                submitted.append(value)
+                yield value
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for index, result in enumerate(ordered_map(executor, lambda value: value, values(), max_pending)):
+                assert result == index
+                assert len(submitted) <= index + max_pending + 1
+
+    def test_stream_items_in_order(self):
+        def produce(value):
+            for item in range(value % 4):
+                self._delay(value + item)
+                yield value, item
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                closing(ordered_stream_map(executor, produce, range(12), max_buffered=2)) as streams:
+            result = [list(items) for items in streams]
+
+        assert result == [[(value, item) for item in range(value % 4)] for value in range(12)]
+
+    def test_stream_buffered_bound(self):
+        max_buffered = 2
+        lock = threading.Lock()
+        counters = dict(produced=0, consumed=0)
+
+        def produce(value):
+            for item in range(10):
+                with lock:
+                    counters['produced'] += 1
+                yield item
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                closing(ordered_stream_map(executor, produce, range(8), max_buffered)) as streams:
+            for items in streams:
+                for _ in items:
+                    time.sleep(0.001)
+                    with lock:
+                        counters['consumed'] += 1
+                        # Each producer holds at most its queue and the item it is putting,
+                        # besides the item being processed by the consumer
+                        held = counters['produced'] - counters['consumed']
+                        assert held <= self.max_workers * (max_buffered + 1) + 1
+
+        assert counters['consumed'] == 80
+
+    def test_stream_error(self):
+        def produce(value):
+            yield value
+            if value == 2:
+                raise ValueError(value)
+            yield value
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                closing(ordered_stream_map(executor, produce, range(5), max_buffered=2)) as streams:
+            with pytest.raises(ValueError):
+                for items in streams:
+                    list(items)
+
+    def test_stream_error_cancels_producers(self):
+        started = []
+
+        def produce(value):
+            started.append(value)
+            if value == 0:
+                raise ValueError(value)
+            for item in range(100):
+                time.sleep(0.001)
+                yield item
+
+        with ThreadPoolExecutor(max_workers=2) as executor, \
+                closing(ordered_stream_map(executor, produce, range(10), max_buffered=1)) as streams:
+            with pytest.raises(ValueError):
+                list(next(streams))
+
+        # The first failure stops the running producers and cancels the queued ones
+        assert set(started) <= {0, 1}
+
+    def test_stream_early_close(self):
+        started = []
+        closed = []
+
+        def produce(value):
+            started.append(value)
+            try:
+                for item in range(100):
+                    yield item
+            finally:
+                closed.append(value)
+
+        with ThreadPoolExecutor(max_workers=2) as executor, \
+                closing(ordered_stream_map(executor, produce, range(6), max_buffered=1)) as streams:
+            assert next(next(streams)) == 0
+
+        # Closing the stream stops the blocked producers, so the executor shutdown does not hang,
+        # and cancels the ones not started
+        assert sorted(closed) == sorted(started)
+        assert len(started) < 6